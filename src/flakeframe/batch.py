@@ -0,0 +1,183 @@
+# Headless snapshots for a list of places, e.g. from cron: weather + map per site written to files
+# network work (geocoding, weather, tiles) happens once up front in this process, the renders are pure cpu
+# and go to a process pool so they scale with cores
+
+import json
+import multiprocessing
+import os
+import re
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataclasses import asdict
+from flakeframe.geocode import parse_coordinates
+from flakeframe.map import render_map, prefetch_maps, set_cell_size, map_geometry, optimizer_name, DEFAULT_CELL
+from flakeframe.mbtiles import configure_tile_pack, tile_pack_settings
+from flakeframe.tilecache import configure_tile_cache, get_tile_store, tile_cache_settings
+from flakeframe.weather import fetch_weather_batch
+
+FORMATS = ("ansi", "plain", "json")
+HOURS_SHOWN = 6
+DAYS_SHOWN = 5
+ANSI = re.compile(r"\x1b\[[0-9;]*m")
+
+def parse_size(text):
+    # "120x40" -> (120, 40)
+    try:
+        w, h = (int(v) for v in text.lower().split("x"))
+    except ValueError:
+        raise ValueError(f"expected WIDTHxHEIGHT, got {text!r}")
+    return w, h
+
+def read_sites(args):
+    sites = list(args.sites)
+    if args.file:
+        with open(args.file, encoding = "utf-8") as f:
+            for line in f:
+                line = line.split("#", 1)[0].strip()
+                if line:
+                    sites.append(line)
+    return sites
+
+def slug(text) -> str:
+    return re.sub(r"[^\w.-]+", "_", text).strip("_")[:60] or "site"
+
+def init_worker(cell, cache, pack):
+    # the parent owns the tile cache files, workers only read what it prefetched
+    set_cell_size(cell)
+    configure_tile_cache(readonly = True, **cache)
+    configure_tile_pack(**pack)
+
+def render_site(lat, lon, zoom, size, fast, native):
+    start = time.perf_counter()
+    timings = {}
+    frame = render_map(lat, lon, zoom, fast = fast, size = size, native = native, timings = timings)
+    timings["render"] = time.perf_counter() - start
+    timings.pop("resampler", None)
+    return frame, timings
+
+def weather_lines(data):
+    # short text version of the map view's weather box
+    now = data.current
+    temp = data.units_temp
+    precip = data.units_precip
+    lines = [
+        f"{now.time.strftime("%Y-%m-%d %I:%M %p")}  {now.temperature:.0f}{temp} {now.condition}, "
+        f"wind {now.wind_direction_str} {now.wind_speed_kmh:.0f}km/h, {now.precipitation}{precip}",
+    ]
+    for h in data.hourly.next_hours(HOURS_SHOWN):
+        lines.append(f"  {h.time.strftime("%I%p").lower()}  {h.temperature:4.0f}{temp} {h.condition}, {h.precipitation:.1f}{precip}")
+    for d in data.daily[1:DAYS_SHOWN + 1]:
+        lines.append(f"  {d.date.strftime("%a")}   {d.temp_min:.0f} to {d.temp_max:.0f}{temp} {d.condition}, {d.precipitation_sum:.1f}{precip}")
+    return lines
+
+def weather_json(data):
+    if data is None:
+        return None
+    return {
+        "current": asdict(data.current),
+        "hourly": [asdict(h) for h in data.hourly.next_hours(24)],
+        "daily": [asdict(d) for d in data.daily],
+        "units_temp": data.units_temp,
+        "units_precip": data.units_precip,
+    }
+
+def write_outputs(site, frame, weather, formats, outdir):
+    # -> list of files written
+    base = os.path.join(outdir, f"{site["index"]:03d}-{slug(site["query"])}")
+    header = f"{site["query"]} ({site["lat"]:+.4f}, {site["lon"]:+.4f})"
+    lines = weather_lines(weather) if weather is not None else ["weather unavailable"]
+    text = "\n".join([header] + lines) + "\n" + frame + "\n"
+    written = []
+    if "ansi" in formats:
+        with open(base + ".ansi", "w", encoding = "utf-8") as f:
+            f.write(text)
+        written.append(base + ".ansi")
+    if "plain" in formats:
+        with open(base + ".txt", "w", encoding = "utf-8") as f:
+            f.write(ANSI.sub("", text))
+        written.append(base + ".txt")
+    if "json" in formats:
+        doc = dict(site, weather = weather_json(weather), map = frame)
+        with open(base + ".json", "w", encoding = "utf-8") as f:
+            json.dump(doc, f, default = str, ensure_ascii = False, indent = 1)
+        written.append(base + ".json")
+    return written
+
+def print_summary(results, wall, workers, out = sys.stderr):
+    print(f"{"site":32} {"resolve":>8} {"render":>8} {"compose":>8} {"glyphs":>8}  status", file = out)
+    busy = 0.0
+    for site in results:
+        t = site["timings"]
+        busy += t.get("render", 0)
+        cols = [f"{t[k]:8.3f}" if k in t else f"{"-":>8}" for k in ("resolve", "render", "map render", "glyphs")]
+        print(f"{site["query"][:32]:32} {" ".join(cols)}  {site["status"]}", file = out)
+    ok = sum(site["status"] == "ok" for site in results)
+    print(f"{ok}/{len(results)} sites in {wall:.2f}s on {workers} workers, "
+          f"{busy:.2f}s of rendering ({busy / wall if wall else 0:.1f}x parallel)", file = out)
+
+def batch_command(args, config):
+    formats = [f.strip() for f in args.format.split(",") if f.strip()]
+    for f in formats:
+        if f not in FORMATS:
+            print(f"unknown format {f!r}, pick from {", ".join(FORMATS)}", file = sys.stderr)
+            return 2
+    try:
+        size = parse_size(args.size)
+        cell = parse_size(args.cell) if args.cell else DEFAULT_CELL
+    except ValueError as e:
+        print(e, file = sys.stderr)
+        return 2
+    sites = read_sites(args)
+    if not sites:
+        print("no sites given", file = sys.stderr)
+        return 2
+    native = (args.renderer or config["DEFAULT"].get("renderer", "img2unicode")) == "native"
+    workers = args.workers or os.cpu_count() or 1
+    os.makedirs(args.output, exist_ok = True)
+    set_cell_size(cell)
+    start = time.perf_counter()
+
+    # names -> coordinates, one at a time since nominatim is rate limited anyway
+    results = []
+    for i, query in enumerate(sites):
+        t = time.perf_counter()
+        lat, lon, _ = parse_coordinates(query, final = True)
+        site = {"index": i, "query": query, "lat": lat, "lon": lon, "zoom": args.zoom, "size": list(size),
+                "renderer": optimizer_name(args.fast, native), "status": "ok", "files": [],
+                "timings": {"resolve": time.perf_counter() - t}}
+        if lat is None or lon is None:
+            site["status"] = "not found"
+        results.append(site)
+    todo = [site for site in results if site["status"] == "ok"]
+
+    # one weather request for everything, one pass over the tiles every map needs
+    weather = fetch_weather_batch([(s["lat"], s["lon"]) for s in todo], config)
+    _, _, source, _ = map_geometry(size, cell)
+    prefetch_maps([(s["lat"], s["lon"]) for s in todo], args.zoom, source)
+    get_tile_store().flush(force = True)
+
+    # spawn, not fork: the fetch pool threads are still around and fork doesn't mix with threads
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(workers, mp_context = context, initializer = init_worker, initargs = (cell, tile_cache_settings(), tile_pack_settings())) as pool:
+        futures = {
+            pool.submit(render_site, s["lat"], s["lon"], args.zoom, size, args.fast, native): (s, w)
+            for s, w in zip(todo, weather)
+        }
+        for future in as_completed(futures):
+            site, data = futures[future]
+            try:
+                frame, timings = future.result()
+            except Exception as e: # one bad site shouldn't sink the rest
+                site["status"] = f"failed: {e}"
+                continue
+            site["timings"].update(timings)
+            site["files"] = write_outputs(site, frame, data, formats, args.output)
+            if data is None:
+                site["status"] = "ok, no weather"
+
+    wall = time.perf_counter() - start
+    with open(os.path.join(args.output, "summary.json"), "w", encoding = "utf-8") as f:
+        json.dump({"wall": wall, "workers": workers, "sites": results}, f, indent = 1)
+    print_summary(results, wall, workers)
+    return 0 if all(site["status"].startswith("ok") for site in results) else 1
@@ -0,0 +1,221 @@
+# Render pipeline benchmarks, offline and repeatable
+# python -m flakeframe.bench [--json out.json] [--baseline old.json]
+# tiles are synthetic and seeded into a throwaway cache, so nothing here touches the network
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+from io import BytesIO
+import numpy as np
+from PIL import Image
+
+BENCH_LAT, BENCH_LON = 45.52, -122.68
+SIZES = "80x24,120x40,200x60"
+ZOOMS = "6,11,16"
+REPEAT = 5
+THRESHOLD = 0.15  # slower than the baseline by more than this is a regression
+NOISE_FLOOR = 5e-4 # seconds, differences below this are timer noise
+
+def synthetic_tile(z, x, y, size = 256):
+    # fixed per tile, with edges and gradients like real imagery so the optimizers do real work
+    rng = np.random.default_rng(hash((z, x, y)) & 0xffffffff)
+    yy, xx = np.mgrid[0:size, 0:size].astype(np.float32)
+    img = np.stack([
+        128 + 90 * np.sin((xx + x * 17) / 29),
+        128 + 90 * np.cos((yy + y * 13) / 41),
+        255 * (((xx + z * 7) // 32 + yy // 32) % 2),
+    ], axis = 2) + rng.normal(0, 10, (size, size, 3))
+    out = BytesIO()
+    Image.fromarray(np.clip(img, 0, 255).astype(np.uint8)).save(out, "PNG")
+    return out.getvalue()
+
+def seed_tiles(sizes, zooms, cell):
+    # every tile the matrix asks for, stored fresh so compose never goes looking for it
+    from flakeframe.map import attribution_height, map_geometry, tile_provider, view_tiles
+    from flakeframe.tilecache import get_tile_store
+    from flakeframe.tilegrid import grid_tiles, tile_lines
+    provider = tile_provider()
+    store = get_tile_store()
+    strip = attribution_height(provider)
+    count = 0
+    for size in sizes:
+        cols, lines, source, _ = map_geometry(size, cell)
+        for zoom in zooms:
+            tiles = set(view_tiles(BENCH_LAT, BENCH_LON, zoom, source[0], source[1] + strip, provider.tile_size()))
+            tiles.update(grid_tiles(*pan_point(zoom), zoom, cols, lines, tile_lines(cell)))
+            tiles.update(grid_tiles(BENCH_LAT, BENCH_LON, zoom, cols, lines, tile_lines(cell)))
+            for x, y in sorted(tiles):
+                if not store.fresh(provider.name(), zoom, x, y):
+                    store.put(provider.name(), zoom, x, y, synthetic_tile(zoom, x, y))
+                    count += 1
+    store.flush()
+    return count
+
+def pan_point(zoom):
+    # a quarter tile east of the bench centre, most tiles shared with it
+    from flakeframe.map import offset_latlon
+    return offset_latlon(BENCH_LAT, BENCH_LON, zoom, 64, 0)
+
+def measure(fn, repeat):
+    # fn can return its own time in seconds when it has setup that shouldn't count
+    fn() # warm up: jit, caches, lazy imports
+    runs = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        took = fn()
+        runs.append(took if isinstance(took, float) else time.perf_counter() - start)
+    return {"median": statistics.median(runs), "min": min(runs), "runs": repeat}
+
+def run_matrix(sizes, zooms, repeat, cell, only = None, progress = None):
+    from flakeframe.cells import grid_to_ansi
+    from flakeframe.map import compose_map, convert_map, map_geometry, pick_resampler
+    from flakeframe.screen import parse
+    from flakeframe.tilegrid import glyph_cache, tiled_cells
+    results = {}
+
+    def bench(key, fn):
+        if only and not any(part in key for part in only):
+            return
+        results[key] = measure(fn, repeat)
+        if progress:
+            progress(key, results[key])
+
+    for size in sizes:
+        cols, lines, source, grid = map_geometry(size, cell)
+        name = f"{size[0]}x{size[1]}"
+        for zoom in zooms:
+            bench(f"{name}/z{zoom}/compose", lambda: compose_map(BENCH_LAT, BENCH_LON, zoom, source, source))
+
+        # everything after compose only cares about the size
+        composed = compose_map(BENCH_LAT, BENCH_LON, zooms[0], source, source)
+        resampler = pick_resampler(source, grid)
+        bench(f"{name}/resize", lambda: composed.resize(grid, resample = resampler) if resampler is not None else composed)
+        image = composed.resize(grid, resample = resampler) if resampler is not None else composed
+
+        for optimizer, fast, native in (("block", False, False), ("quad", True, False),
+                                        ("native-half", False, True), ("native-quad", True, True)):
+            bench(f"{name}/glyphs-{optimizer}", lambda: convert_map(image, cols, fast, native))
+
+        # per-tile glyphs: every tile new, a pan with most of them cached, and nothing new at all
+        zoom = zooms[0]
+        def tiled_pan():
+            glyph_cache.clear()
+            tiled_cells(BENCH_LAT, BENCH_LON, zoom, cols, lines, fast = True)
+            start = time.perf_counter()
+            tiled_cells(*pan_point(zoom), zoom, cols, lines, fast = True)
+            return time.perf_counter() - start
+        def tiled_new():
+            glyph_cache.clear()
+            tiled_cells(BENCH_LAT, BENCH_LON, zoom, cols, lines, fast = True)
+        bench(f"{name}/tiled-new", tiled_new)
+        bench(f"{name}/tiled-pan", tiled_pan)
+        bench(f"{name}/tiled-cached", lambda: tiled_cells(BENCH_LAT, BENCH_LON, zoom, cols, lines, fast = True))
+
+        rows = convert_map(image, cols, fast = True, native = True)
+        bench(f"{name}/ansi-assemble", lambda: grid_to_ansi(rows))
+        canvas = convert_map(image.resize((grid[0] * 2, grid[1] * 2)), cols * 2, fast = True, native = True)
+        bench(f"{name}/ansi-window", lambda: grid_to_ansi(canvas, cols // 2, lines // 2, cols, lines))
+        frame = grid_to_ansi(rows)
+        bench(f"{name}/ansi-parse", lambda: parse(frame, *size))
+    return results
+
+def compare(results, baseline, threshold = THRESHOLD):
+    # -> (rows of (key, baseline, now, ratio, verdict), regression count)
+    rows = []
+    regressions = 0
+    for key, now in results.items():
+        old = baseline.get(key)
+        if old is None:
+            rows.append((key, None, now["median"], None, "new"))
+            continue
+        ratio = now["median"] / old["median"] if old["median"] else float("inf")
+        verdict = "ok"
+        if ratio > 1 + threshold and now["median"] - old["median"] > NOISE_FLOOR:
+            verdict = "REGRESSION"
+            regressions += 1
+        elif ratio < 1 - threshold:
+            verdict = "faster"
+        rows.append((key, old["median"], now["median"], ratio, verdict))
+    for key in baseline:
+        if key not in results:
+            rows.append((key, baseline[key]["median"], None, None, "missing"))
+    return rows, regressions
+
+def parse_list(text, parse):
+    return [parse(part) for part in text.split(",") if part.strip()]
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(prog = "python -m flakeframe.bench", description = "offline render pipeline benchmarks")
+    parser.add_argument("--sizes", default = SIZES, help = f"terminal sizes, default {SIZES}")
+    parser.add_argument("--zooms", default = ZOOMS, help = f"zoom levels for the compose stage, default {ZOOMS}")
+    parser.add_argument("--repeat", type = int, default = REPEAT)
+    parser.add_argument("--only", help = "comma separated substrings, only run cases containing one, e.g. glyphs,200x60")
+    parser.add_argument("--json", help = "write the results here")
+    parser.add_argument("--baseline", help = "results json from an earlier run to compare against")
+    parser.add_argument("--threshold", type = float, default = THRESHOLD, help = f"allowed slowdown, default {THRESHOLD}")
+    args = parser.parse_args(argv)
+
+    sizes = parse_list(args.sizes, lambda s: tuple(int(v) for v in s.lower().split("x")))
+    zooms = parse_list(args.zooms, int)
+    only = parse_list(args.only, str.strip) if args.only else None
+
+    # a cache of our own, before anything opens the real one, gone again afterwards
+    with tempfile.TemporaryDirectory(prefix = "flakeframe-bench-", ignore_cleanup_errors = True) as cache:
+        os.environ["XDG_CACHE_HOME"] = cache
+        if sys.platform == "win32":
+            os.environ["LOCALAPPDATA"] = cache
+        from flakeframe.tilecache import get_tile_store
+        try:
+            return bench(args, sizes, zooms, only)
+        finally:
+            get_tile_store().close() # while the directory is still there, atexit would find it gone
+
+def bench(args, sizes, zooms, only):
+    from flakeframe.map import set_cell_size, DEFAULT_CELL
+    set_cell_size(DEFAULT_CELL) # never ask the terminal, results shouldn't depend on the font
+
+    seeded = seed_tiles(sizes, zooms, DEFAULT_CELL)
+    print(f"{seeded} synthetic tiles, {args.repeat} runs per case", file = sys.stderr)
+    def progress(key, result):
+        print(f"{key:32} {result["median"] * 1000:9.2f} ms  (min {result["min"] * 1000:.2f})", file = sys.stderr)
+    results = run_matrix(sizes, zooms, args.repeat, DEFAULT_CELL, only, progress)
+
+    doc = {
+        "meta": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "machine": platform.machine(),
+            "cpus": os.cpu_count(),
+            "cell": list(DEFAULT_CELL),
+            "repeat": args.repeat,
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        },
+        "results": results,
+    }
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(doc, f, indent = 1)
+
+    if not args.baseline:
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)["results"]
+    if only:
+        baseline = {k: v for k, v in baseline.items() if any(part in k for part in only)}
+    rows, regressions = compare(results, baseline, args.threshold)
+    print(f"\n{"case":32} {"baseline":>10} {"now":>10} {"ratio":>7}", file = sys.stderr)
+    for key, old, now, ratio, verdict in rows:
+        old_s = f"{old * 1000:8.2f}ms" if old is not None else f"{"-":>10}"
+        now_s = f"{now * 1000:8.2f}ms" if now is not None else f"{"-":>10}"
+        ratio_s = f"{ratio:6.2f}x" if ratio is not None else f"{"-":>7}"
+        print(f"{key:32} {old_s} {now_s} {ratio_s}  {verdict}", file = sys.stderr)
+    print(f"{regressions} regressions over {args.threshold:.0%}", file = sys.stderr)
+    return 1 if regressions else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,140 @@
+# Native block renderer, plain numpy instead of img2unicode's optimizers
+# expects the same 8x16-pixels-per-character grid that render_map hands img2unicode
+
+import sys
+import time
+import numpy as np
+from PIL import Image
+from flakeframe.cells import cells_from_arrays, grid_to_ansi
+
+GLYPH_W, GLYPH_H = 8, 16
+
+# quadrant glyphs by bitmask, bit set = foreground: 1 top left, 2 top right, 4 bottom left, 8 bottom right
+QUAD_GLYPHS = " ▘▝▀▖▌▞▛▗▚▐▜▄▙▟█"
+QUAD_MASKS = np.array([[(m >> b) & 1 for b in range(4)] for m in range(16)], dtype = np.float32)
+QUAD_CHOICES = np.arange(0, 16, 2) # top left always background, the rest are the same split with colours swapped
+
+def to_array(image):
+    # uint8 copy of pillow's pixels, stays uint8 until cell_blocks averages it
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    return np.asarray(image)
+
+def cell_blocks(arr, split_y, split_x):
+    # mean colour of each sub-block: (rows, cols, split_y * split_x, 3)
+    rows, cols = arr.shape[0] // GLYPH_H, arr.shape[1] // GLYPH_W
+    arr = arr[:rows * GLYPH_H, :cols * GLYPH_W]
+    blocks = arr.reshape(rows, split_y, GLYPH_H // split_y, cols, split_x, GLYPH_W // split_x, 3)
+    means = blocks.mean(axis = (2, 5), dtype = np.float32)  # rows, split_y, cols, split_x, 3
+    return means.transpose(0, 2, 1, 3, 4).reshape(rows, cols, split_y * split_x, 3)
+
+def half_cells(arr):
+    # upper half block, top half is the foreground
+    sub = cell_blocks(arr, 2, 1)
+    rows, cols = sub.shape[:2]
+    glyphs = np.full((rows, cols), 3, dtype = np.intp) # ▀
+    return glyphs, sub[:, :, 0], sub[:, :, 1]
+
+def quad_cells(arr):
+    sub = cell_blocks(arr, 2, 2)                      # rows, cols, 4, 3
+    masks = QUAD_MASKS[QUAD_CHOICES]                  # 8, 4
+    counts = masks.sum(axis = 1)                      # 8
+
+    # fg/bg are the means of the quadrants on each side of the split
+    fg_sum = np.einsum("rcqk,mq->rcmk", sub, masks)
+    total = sub.sum(axis = 2)[:, :, None, :]
+    bg_sum = total - fg_sum
+    with np.errstate(invalid = "ignore", divide = "ignore"):
+        fg = fg_sum / counts[None, None, :, None]
+        bg = bg_sum / (4 - counts)[None, None, :, None]
+    fg = np.nan_to_num(fg)
+
+    # squared error of each split = sum of squares minus what the means explain
+    sq = (sub * sub).sum(axis = (2, 3))[:, :, None]
+    explained = (fg * fg_sum).sum(axis = 3) + (bg * bg_sum).sum(axis = 3)
+    best = np.argmin(sq - explained, axis = 2)
+
+    r, c = np.indices(best.shape)
+    glyphs = QUAD_CHOICES[best]
+    fg = fg[r, c, best]
+    bg = bg[r, c, best]
+    fg[glyphs == 0] = bg[glyphs == 0] # blank cell, fg is whatever
+    return glyphs, fg, bg
+
+def block_cells(image, quad = False):
+    arr = to_array(image)
+    glyphs, fg, bg = quad_cells(arr) if quad else half_cells(arr)
+    fg = np.clip(fg + 0.5, 0, 255).astype(np.uint8)
+    bg = np.clip(bg + 0.5, 0, 255).astype(np.uint8)
+    return cells_from_arrays(glyphs, fg, bg, QUAD_GLYPHS)
+
+def render_blocks(image, quad = False) -> str:
+    return grid_to_ansi(block_cells(image, quad))
+
+def reconstruct(glyphs, fg, bg):
+    # paint the cells back into pixels so they can be compared with the source
+    masks = QUAD_MASKS[glyphs].reshape(*glyphs.shape, 2, 2)
+    m = np.repeat(np.repeat(masks, GLYPH_H // 2, axis = 2), GLYPH_W // 2, axis = 3)[..., None]
+    cells = m * fg[:, :, None, None, :] + (1 - m) * bg[:, :, None, None, :]
+    rows, cols = glyphs.shape
+    return cells.transpose(0, 2, 1, 3, 4).reshape(rows * GLYPH_H, cols * GLYPH_W, 3)
+
+def psnr(a, b):
+    mse = np.mean((a.astype(np.float32) - b.astype(np.float32)) ** 2)
+    return float("inf") if mse == 0 else 10 * np.log10(255 ** 2 / mse)
+
+def synthetic_image(cols, rows):
+    # something with edges, gradients and noise so no renderer gets an easy ride
+    h, w = rows * GLYPH_H, cols * GLYPH_W
+    y, x = np.mgrid[0:h, 0:w].astype(np.float32)
+    rng = np.random.default_rng(1)
+    img = np.stack([
+        128 + 100 * np.sin(x / 37) * np.cos(y / 23),
+        128 + 100 * np.sin((x + y) / 51),
+        255 * ((x // 64 + y // 48) % 2),
+    ], axis = 2) + rng.normal(0, 12, (h, w, 3))
+    return Image.fromarray(np.clip(img, 0, 255).astype(np.uint8))
+
+def compare(image, repeat = 3):
+    # quality/speed against img2unicode on the same grid image
+    from img2unicode import FastGenericDualOptimizer, FastQuadDualOptimizer, Renderer
+    source = to_array(image)
+    cols = source.shape[1] // GLYPH_W
+    results = []
+
+    for name, optimizer in (("img2unicode block", FastGenericDualOptimizer("block")), ("img2unicode quad", FastQuadDualOptimizer())):
+        renderer = Renderer(default_optimizer = optimizer, max_w = cols)
+        start = time.perf_counter()
+        for _ in range(repeat):
+            renderer.render_terminal(image, _NullOut(), optimizer = optimizer)
+        elapsed = (time.perf_counter() - start) / repeat
+        recov = np.asarray(renderer.prerender(image, optimizer).convert("RGB"))
+        results.append((name, elapsed, psnr(recov, source[:recov.shape[0], :recov.shape[1]])))
+
+    for name, quad in (("native half", False), ("native quad", True)):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            render_blocks(image, quad = quad)
+        elapsed = (time.perf_counter() - start) / repeat
+        glyphs, fg, bg = quad_cells(source) if quad else half_cells(source)
+        recov = reconstruct(glyphs, fg, bg)
+        results.append((name, elapsed, psnr(recov, source[:recov.shape[0], :recov.shape[1]])))
+
+    return results
+
+class _NullOut:
+    def write(self, s):
+        pass
+
+if __name__ == "__main__":
+    # python -m flakeframe.blocks [image] [cols rows]
+    args = sys.argv[1:]
+    cols, rows = (int(args[-2]), int(args[-1])) if len(args) >= 2 else (160, 48)
+    if args and not args[0].isdigit():
+        img = Image.open(args[0]).convert("RGB").resize((cols * GLYPH_W, rows * GLYPH_H), Image.BILINEAR)
+    else:
+        img = synthetic_image(cols, rows)
+
+    print(f"{cols}x{rows} cells")
+    for name, elapsed, quality in compare(img):
+        print(f"{name:18} {elapsed * 1000:8.1f} ms   {quality:5.2f} dB PSNR")
@@ -0,0 +1,84 @@
+# Shared cache helpers
+
+import os
+import sys
+import threading
+from collections import OrderedDict
+
+def cache_dir(*parts) -> str:
+    if sys.platform == "win32":
+        base = os.environ.get("LOCALAPPDATA", os.path.expanduser("~"))
+    else:
+        base = os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache"))
+
+    path = os.path.join(base, "flakeframe", *parts)
+    os.makedirs(path, exist_ok = True)
+    return path
+
+class LRUCache:
+    # small thread-safe LRU that keeps hit/miss counts so it can be sized
+    def __init__(self, maxsize = 32):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, default = None):
+        with self.lock:
+            if key in self.data:
+                self.data.move_to_end(key)
+                self.hits += 1
+                return self.data[key]
+            self.misses += 1
+            return default
+
+    def peek(self, key, default = None):
+        # look without counting or bumping
+        with self.lock:
+            return self.data.get(key, default)
+
+    def put(self, key, value):
+        with self.lock:
+            self.data[key] = value
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last = False)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+    def values(self) -> list:
+        # a snapshot, oldest first, without counting or bumping
+        with self.lock:
+            return list(self.data.values())
+
+    def items(self) -> list:
+        # same, with keys
+        with self.lock:
+            return list(self.data.items())
+
+    def discard_where(self, pred):
+        # drop every entry whose key pred says yes to
+        with self.lock:
+            for key in [key for key in self.data if pred(key)]:
+                del self.data[key]
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.data
+
+    def __len__(self):
+        return len(self.data)
+
+    def stats(self) -> dict:
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "size": len(self.data),
+                "maxsize": self.maxsize,
+                "hit_rate": self.hits / total if total else 0.0,
+            }
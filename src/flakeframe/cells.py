@@ -0,0 +1,22 @@
+# Character cell grids, a frame as rows of self-contained cells so it can be sliced and stitched
+
+RESET = "\x1b[0m"
+
+def cells_from_arrays(chars, fg, bg, table = None):
+    # chars are codepoints, or indexes into table; fg/bg are uint8 (rows, cols, 3)
+    chars = chars.tolist()
+    fg = fg.tolist()
+    bg = bg.tolist()
+    rows = []
+    for c_row, f_row, b_row in zip(chars, fg, bg):
+        rows.append([
+            f"\x1b[38;2;{f[0]};{f[1]};{f[2]}m\x1b[48;2;{b[0]};{b[1]};{b[2]}m{table[c] if table else chr(c)}"
+            for c, f, b in zip(c_row, f_row, b_row)
+        ])
+    return rows
+
+def grid_to_ansi(rows, x = 0, y = 0, w = None, h = None) -> str:
+    # a w x h window of the grid as one string, rows end with a reset
+    w = len(rows[0]) - x if w is None and rows else w
+    h = len(rows) - y if h is None else h
+    return "\n".join("".join(row[x:x + w]) + RESET for row in rows[y:y + h])
@@ -0,0 +1,216 @@
+# Saved locations side by side, weather for all of them in one request and a little map each
+
+import math
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from flakeframe.cache import LRUCache
+from flakeframe.input import read_key
+from flakeframe.map import render_cells, get_cell_size
+from flakeframe.mapview import MapViewUI
+from flakeframe.screen import screen
+from flakeframe.ui import get_terminal_size, display_width, display_center, saved_locations, remove_location
+from flakeframe.weather import fetch_weather_batch
+
+PANEL_W = 42      # outer size of one site, borders included
+PANEL_H = 7
+THUMB_COLS = 14   # map thumbnail, left side of the panel
+THUMB_LINES = PANEL_H - 2
+THUMB_ZOOM = 11   # town sized
+THUMB_WORKERS = 4 # tiles come from the shared download pool, this is just the compose + glyph work
+TEXT_W = PANEL_W - THUMB_COLS - 5
+
+COLOR_RESET = "\x1b[0m"
+COLOR_BORDER = "\x1b[38;2;40;230;180m"
+COLOR_ACTIVE = "\x1b[38;2;255;128;120m"
+COLOR_DIM = "\x1b[38;2;150;150;150m"
+COLOR_KEYS = "\x1b[32m"
+COLOR_TEXT = "\x1b[38;5;86m"
+
+# thumbnail cell rows by place, kept across visits so going back to the dashboard is instant
+thumb_cache = LRUCache(64)
+
+def fit(text, width) -> str:
+    # pad to width, plain text gets cut short, coloured text is assumed to fit
+    if display_width(text) > width and "\x1b" not in text:
+        text = text[:width - 1] + "…"
+    return text + " " * max(0, width - display_width(text))
+
+def temp_colour(t) -> str:
+    return "\x1b[38;2;255;100;0m" if t > 0 else "\x1b[38;2;0;128;255m"
+
+def thumb_key(lat, lon):
+    return (round(lat, 4), round(lon, 4), THUMB_ZOOM, THUMB_COLS, THUMB_LINES)
+
+class DashboardUI:
+    def __init__(self, config):
+        self.config = config
+        self.sites = saved_locations(config) # [(name, lat, lon)]
+        self.weather = [None] * len(self.sites)
+        self.weather_loading = False
+        self.updated = None
+        self.selected = 0
+        self.top = 0 # first panel row on screen
+        self.native = config["DEFAULT"].get("renderer", "img2unicode") == "native"
+        self.thumbs = {} # thumb key -> future
+        self.executor = ThreadPoolExecutor(THUMB_WORKERS, thread_name_prefix = "thumb")
+        self.changed = threading.Event()
+        get_cell_size() # workers can't ask the terminal
+
+    def load_weather(self, force = False):
+        # whatever is cached goes up straight away, then one request for everything that's missing or old
+        locations = [(lat, lon) for _, lat, lon in self.sites]
+        self.weather = [
+            new or old for new, old in zip(fetch_weather_batch(locations, self.config, cached_only = True), self.weather)
+        ]
+        self.weather_loading = True
+        sites = self.sites
+        def worker():
+            try:
+                results = fetch_weather_batch(locations, self.config, force = force)
+                if sites is self.sites:
+                    self.weather = [new or old for new, old in zip(results, self.weather)]
+                    self.updated = datetime.now()
+            finally:
+                self.weather_loading = False
+                self.changed.set()
+        threading.Thread(target = worker, daemon = True).start()
+
+    def load_thumbs(self):
+        # every thumbnail renders at once on the pool, each one redraws when it lands
+        for _, lat, lon in self.sites:
+            key = thumb_key(lat, lon)
+            if key in self.thumbs or thumb_cache.peek(key) is not None:
+                continue
+            future = self.executor.submit(self.render_thumb, key)
+            future.add_done_callback(lambda _: self.changed.set())
+            self.thumbs[key] = future
+
+    def render_thumb(self, key):
+        lat, lon, zoom, cols, lines = key
+        rows = render_cells(lat, lon, zoom, cols, lines, fast = True, native = self.native)
+        thumb_cache.put(key, rows)
+        return rows
+
+    def layout(self):
+        # -> (panels per row, panel rows on screen, left edge)
+        term_w, term_h = get_terminal_size()
+        columns = max(1, (term_w - 2) // PANEL_W)
+        rows = max(1, (term_h - 4) // PANEL_H)
+        return columns, rows, (term_w - columns * PANEL_W) // 2 + 1
+
+    def draw_ui(self):
+        screen.begin()
+        term_w, term_h = get_terminal_size()
+        screen.write(f"\x1b[1;1H{COLOR_BORDER}{display_center("flakeframe | saved locations", term_w)}{COLOR_RESET}")
+        if self.weather_loading:
+            status = "refreshing weather..."
+        elif self.updated is not None:
+            status = f"{len(self.sites)} sites, weather from {self.updated.strftime("%I:%M %p")}"
+        else:
+            status = f"{len(self.sites)} sites"
+        screen.write(f"\x1b[2;1H{COLOR_DIM}{display_center(status, term_w)}{COLOR_RESET}")
+
+        if not self.sites:
+            msg = "Nothing saved yet, press [f] on a map to keep a place here"
+            screen.write(f"\x1b[{term_h // 2};1H{display_center(msg, term_w)}")
+        else:
+            columns, rows, left = self.layout()
+            row = self.selected // columns
+            self.top = min(max(self.top, row - rows + 1), row)
+            for i in range(self.top * columns, min(len(self.sites), (self.top + rows) * columns)):
+                x = left + (i % columns) * PANEL_W
+                y = 3 + (i // columns - self.top) * PANEL_H
+                self.draw_panel(i, x, y)
+
+        controls = f"{COLOR_TEXT}< {COLOR_KEYS}[arrows]{COLOR_TEXT} pick | {COLOR_KEYS}[enter]{COLOR_TEXT} open | {COLOR_KEYS}[r]{COLOR_TEXT}efresh | {COLOR_KEYS}[x]{COLOR_TEXT} remove | {COLOR_KEYS}[esc/q]{COLOR_TEXT} back >"
+        screen.write(f"\x1b[{term_h};{max(1, term_w - display_width(controls) - 4)}H{controls}{COLOR_RESET}")
+        screen.present()
+
+    def draw_panel(self, i, x, y):
+        name, lat, lon = self.sites[i]
+        border = COLOR_ACTIVE if i == self.selected else COLOR_BORDER
+        inner = PANEL_W - 2
+        screen.write(f"\x1b[{y};{x}H{border}╭{"─" * inner}╮")
+        for r in range(THUMB_LINES):
+            screen.write(f"\x1b[{y + 1 + r};{x}H│{" " * inner}│")
+        screen.write(f"\x1b[{y + PANEL_H - 1};{x}H╰{"─" * inner}╯{COLOR_RESET}")
+
+        thumb = thumb_cache.peek(thumb_key(lat, lon))
+        if thumb is not None:
+            for r, cells in enumerate(thumb[:THUMB_LINES]):
+                screen.write(f"\x1b[{y + 1 + r};{x + 1}H{"".join(cells[:THUMB_COLS])}{COLOR_RESET}")
+        else:
+            screen.write(f"\x1b[{y + PANEL_H // 2};{x + 1}H{COLOR_DIM}{display_center("…", THUMB_COLS)}{COLOR_RESET}")
+
+        text_x = x + THUMB_COLS + 2
+        lines = [fit(name, TEXT_W)]
+        data = self.weather[i]
+        if data is None:
+            lines.append(COLOR_DIM + ("loading..." if self.weather_loading else "no weather :(") + COLOR_RESET)
+        else:
+            now = data.current
+            inches = data.units_precip == "inch"
+            precip = f"{now.precipitation:.2f}in" if inches else f"{now.precipitation:.1f}mm"
+            lines.append(f"{temp_colour(now.temperature)}{int(now.temperature):3}°{COLOR_RESET} {now.condition}")
+            lines.append(f"{now.wind_direction_str:>3} {now.wind_speed_kmh:3.0f}km/h  {precip}")
+            if data.daily:
+                today = data.daily[0]
+                lines.append(f"today {temp_colour(today.temp_min)}{int(today.temp_min)}°{COLOR_RESET} to {temp_colour(today.temp_max)}{int(today.temp_max)}°{COLOR_RESET}")
+            hours = data.hourly.next_hours(4)
+            if hours:
+                lines.append(COLOR_DIM + "next " + " ".join(f"{int(h.temperature)}°" if not math.isnan(h.temperature) else "--°" for h in hours) + COLOR_RESET)
+        for r, line in enumerate(lines[:THUMB_LINES]):
+            screen.write(f"\x1b[{y + 1 + r};{text_x}H{line}{COLOR_RESET}")
+
+    def move(self, step):
+        if self.sites:
+            self.selected = min(max(0, self.selected + step), len(self.sites) - 1)
+
+    def reload_sites(self):
+        # after the map view, which can save and unsave places
+        sites = saved_locations(self.config)
+        if sites != self.sites:
+            known = dict(zip(self.sites, self.weather))
+            self.sites = sites
+            self.weather = [known.get(site) for site in sites]
+            self.selected = min(self.selected, max(0, len(sites) - 1))
+            self.load_weather() # new ones are usually cached by the map view already
+            self.load_thumbs()
+
+    def run(self):
+        self.load_weather()
+        self.load_thumbs()
+        self.draw_ui()
+        try:
+            while True:
+                key = read_key(timeout = 0.05)
+                if key is None:
+                    if self.changed.is_set():
+                        self.changed.clear()
+                        self.draw_ui()
+                    continue
+                columns, _, _ = self.layout()
+                if key in ("a", "left"):
+                    self.move(-1)
+                elif key in ("d", "right"):
+                    self.move(1)
+                elif key in ("w", "up"):
+                    self.move(-columns)
+                elif key in ("s", "down"):
+                    self.move(columns)
+                elif key == "r" and self.sites:
+                    self.load_weather(force = True)
+                elif key == "x" and self.sites:
+                    _, lat, lon = self.sites[self.selected]
+                    remove_location(self.config, lat, lon)
+                    self.reload_sites()
+                elif key == "enter" and self.sites:
+                    _, lat, lon = self.sites[self.selected]
+                    MapViewUI(lat, lon, self.config).run()
+                    self.reload_sites()
+                elif key in ("esc", "q"):
+                    return
+                self.draw_ui()
+        finally:
+            self.executor.shutdown(wait = False, cancel_futures = True)
@@ -0,0 +1,206 @@
+# Offline place search, a GeoNames dump imported into a local sqlite index
+
+import io
+import os
+import re
+import sqlite3
+import sys
+import threading
+import time
+import unicodedata
+import zipfile
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import List, Optional
+from flakeframe.cache import cache_dir
+
+GAZETTEER_CLASSES = "PA" # populated places and admin areas, rivers and hotels aren't worth the space
+IMPORT_BATCH = 5000
+FTS_CANDIDATES = 500     # partial matches looked at before ranking by population
+
+SCHEMA = """
+CREATE TABLE places (
+    id INTEGER PRIMARY KEY,
+    name TEXT, key TEXT, akey TEXT,
+    country TEXT, admin1 TEXT, code TEXT,
+    lat REAL, lon REAL, population INTEGER
+);
+CREATE VIRTUAL TABLE names USING fts5(name, content = '', tokenize = "unicode61 remove_diacritics 2", prefix = '2 3');
+"""
+INDEXES = """
+CREATE INDEX places_key ON places (key, population DESC);
+CREATE INDEX places_akey ON places (akey, population DESC);
+"""
+
+@dataclass
+class Place:
+    name: str
+    country: str
+    admin1: str
+    lat: float
+    lon: float
+    population: int
+
+    def label(self) -> str:
+        return f"{self.name}, {self.admin1 + ", " if self.admin1 and not self.admin1.isdigit() else ""}{self.country}"
+
+def gazetteer_path() -> str:
+    return os.path.join(cache_dir(), "gazetteer.db")
+
+def normalize(text) -> str:
+    # lowercase, no accents, single spaces: "  São  Paulo" -> "sao paulo"
+    text = unicodedata.normalize("NFKD", text.strip().lower())
+    text = "".join(ch for ch in text if not unicodedata.combining(ch))
+    return re.sub(r"\s+", " ", text)
+
+@contextmanager
+def open_dump(path):
+    # allCountries.txt, cities500.txt, ... or the zips geonames ships them in, read as a stream either way
+    if zipfile.is_zipfile(path):
+        with zipfile.ZipFile(path) as archive:
+            member = next(n for n in archive.namelist() if n.endswith(".txt") and "readme" not in n.lower())
+            with io.TextIOWrapper(archive.open(member), encoding = "utf-8") as f:
+                yield f
+    else:
+        with open(path, encoding = "utf-8") as f:
+            yield f
+
+def read_dump(lines, classes = GAZETTEER_CLASSES, min_population = 0):
+    # geonames columns: id, name, asciiname, alternatenames, lat, lon, class, code, country, cc2, admin1, ..., population
+    wanted = set(classes) # single letters, so "" (no class) and "PA" itself never match
+    for line in lines:
+        cols = line.rstrip("\n").split("\t")
+        if len(cols) < 15 or cols[6] not in wanted:
+            continue
+        try:
+            population = int(cols[14] or 0)
+            row = (int(cols[0]), cols[1], normalize(cols[1]), normalize(cols[2]), cols[8], cols[10], cols[7],
+                   float(cols[4]), float(cols[5]), population)
+        except ValueError:
+            continue
+        if population >= min_population:
+            yield row
+
+def import_gazetteer(src, dest = None, classes = GAZETTEER_CLASSES, min_population = 0, progress = None) -> int:
+    # builds next to dest and swaps it in at the end, so a half-done import never replaces a working one
+    dest = dest or gazetteer_path()
+    tmp = dest + ".tmp"
+    if os.path.exists(tmp):
+        os.remove(tmp)
+
+    db = sqlite3.connect(tmp)
+    db.execute("PRAGMA journal_mode = OFF")
+    db.execute("PRAGMA synchronous = OFF")
+    db.executescript(SCHEMA)
+    count = 0
+    batch = []
+
+    def flush():
+        db.executemany("INSERT INTO places VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", batch)
+        db.executemany("INSERT INTO names (rowid, name) VALUES (?, ?)",
+                       [(r[0], r[1] if r[2] == r[3] else f"{r[1]} {r[3]}") for r in batch])
+        batch.clear()
+
+    with open_dump(src) as f:
+        for row in read_dump(f, classes, min_population):
+            batch.append(row)
+            count += 1
+            if len(batch) >= IMPORT_BATCH:
+                flush()
+                if progress:
+                    progress(count)
+        flush()
+
+    db.executescript(INDEXES)
+    db.execute("INSERT INTO names (names) VALUES ('optimize')")
+    db.commit()
+    db.close()
+    os.replace(tmp, dest)
+    return count
+
+class Gazetteer:
+    def __init__(self, path):
+        # read only, shared between threads behind a lock
+        self.db = sqlite3.connect(f"file:{path}?mode=ro", uri = True, check_same_thread = False)
+        self.lock = threading.Lock()
+
+    def search(self, query, limit = 5) -> List[Place]:
+        # "paris" or "paris, fr" / "portland, or": exact names, then names starting with it, then any word
+        # starting with it, biggest places first within each
+        name, *quals = [part.strip() for part in query.split(",")]
+        key = normalize(name)
+        quals = [q.upper() for q in quals if q]
+        if not key:
+            return []
+
+        for qualify in ((True, False) if quals else (False,)):
+            where = ""
+            params = []
+            if qualify: # a qualifier nobody matches gets dropped on the second pass
+                marks = ", ".join("?" * len(quals))
+                where = f" AND (country IN ({marks}) OR admin1 IN ({marks}))"
+                params = quals * 2
+            rows = self.query(key, where, params, limit)
+            if rows:
+                return [Place(*row) for row in rows]
+        return []
+
+    def query(self, key, where, params, limit):
+        columns = "name, country, admin1, lat, lon, population"
+        with self.lock:
+            rows = self.db.execute(
+                f"SELECT {columns} FROM places WHERE (key = ? OR akey = ?){where} ORDER BY population DESC LIMIT ?",
+                [key, key] + params + [limit]).fetchall()
+            if rows:
+                return rows
+            rows = self.db.execute(
+                f"SELECT {columns} FROM places WHERE key >= ? AND key < ?{where} ORDER BY population DESC LIMIT ?",
+                [key, key + "\uffff"] + params + [limit]).fetchall()
+            if rows:
+                return rows
+
+            tokens = re.findall(r"\w+", key)
+            if not tokens:
+                return []
+            match = " ".join(f'"{t}"*' for t in tokens)
+            return self.db.execute(
+                f"SELECT {columns} FROM (SELECT rowid FROM names WHERE names MATCH ? LIMIT ?) AS hits "
+                f"JOIN places ON places.id = hits.rowid WHERE 1{where} ORDER BY population DESC LIMIT ?",
+                [match, FTS_CANDIDATES] + params + [limit]).fetchall()
+
+    def resolve(self, query) -> Optional[Place]:
+        found = self.search(query, limit = 1)
+        return found[0] if found else None
+
+_gazetteer = None
+_gazetteer_lock = threading.Lock()
+
+def get_gazetteer() -> Optional[Gazetteer]:
+    # None until someone has run import-gazetteer
+    global _gazetteer
+    with _gazetteer_lock:
+        if _gazetteer is None:
+            path = gazetteer_path()
+            if not os.path.exists(path):
+                return None
+            _gazetteer = Gazetteer(path)
+        return _gazetteer
+
+def import_command(args, config = None):
+    start = time.perf_counter()
+    def progress(n):
+        print(f"\r{n:,} places", end = "", file = sys.stderr, flush = True)
+    count = import_gazetteer(args.dump, args.output, args.classes, args.min_population, progress)
+    print(f"\r{count:,} places imported into {args.output or gazetteer_path()} in {time.perf_counter() - start:.1f}s", file = sys.stderr)
+
+def search_command(args, config = None):
+    gazetteer = get_gazetteer()
+    if gazetteer is None:
+        print("no gazetteer yet, run: flakeframe import-gazetteer allCountries.zip", file = sys.stderr)
+        return 1
+    start = time.perf_counter()
+    places = gazetteer.search(args.query, limit = args.limit)
+    elapsed = time.perf_counter() - start
+    for place in places:
+        print(f"{place.label():40} {place.lat:+9.4f} {place.lon:+10.4f} {place.population:>10,}")
+    print(f"{len(places)} results in {elapsed * 1000:.2f} ms", file = sys.stderr)
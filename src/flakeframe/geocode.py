@@ -1,5 +1,139 @@
+import json
+import os
 import re
 import requests
+import threading
+import time
+from flakeframe.cache import LRUCache, cache_dir
+from flakeframe.gazetteer import get_gazetteer
+from flakeframe.trace import span
+
+NOMINATIM_RATE = 1.0         # requests per second, nominatim's usage policy
+NOT_FOUND_TTL = 7 * 24 * 3600 # places that didn't exist get asked about again after a week
+
+class RateLimiter:
+    # token bucket shared by everything in the process that talks to the same service
+    def __init__(self, rate, burst = 1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = time.monotonic()
+        self.waited = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self) -> float:
+        # blocks until a request is allowed, returns how long that took
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+            self.tokens -= 1 # goes negative to reserve a slot, later callers queue up behind it
+            wait = max(0.0, -self.tokens / self.rate)
+            self.waited += wait
+        if wait:
+            time.sleep(wait)
+        return wait
+
+    def ready(self) -> bool:
+        # would acquire() go through without waiting
+        with self.lock:
+            return self.tokens + (time.monotonic() - self.stamp) * self.rate >= 1
+
+class GeocodeCache(LRUCache):
+    # normalized query -> [lat, lon, fetched], lat None if nominatim found nothing; kept on disk
+    def __init__(self, path, maxsize = 2048):
+        super().__init__(maxsize)
+        self.path = path
+        try:
+            with open(path) as f:
+                for query, entry in json.load(f).items():
+                    self.data[query] = entry
+        except (OSError, ValueError):
+            pass
+
+    def lookup(self, query, count = True):
+        entry = self.get(query) if count else self.peek(query)
+        if entry is not None and entry[0] is None and time.time() - entry[2] > NOT_FOUND_TTL:
+            return None
+        return entry
+
+    def save(self):
+        with self.lock:
+            snapshot = dict(self.data)
+        tmp = self.path + ".tmp"
+        try:
+            with open(tmp, "w") as f:
+                json.dump(snapshot, f)
+            os.replace(tmp, self.path)
+        except OSError:
+            pass
+
+nominatim_limiter = RateLimiter(NOMINATIM_RATE)
+_geocode_cache = None
+_geocode_cache_lock = threading.Lock()
+
+def get_geocode_cache() -> GeocodeCache:
+    global _geocode_cache
+    with _geocode_cache_lock:
+        if _geocode_cache is None:
+            _geocode_cache = GeocodeCache(os.path.join(cache_dir(), "geocode.json"))
+        return _geocode_cache
+
+def normalize_query(text) -> str:
+    # "  New York,NY " and "new york, ny" are the same search
+    text = re.sub(r"\s*,\s*", ", ", text.strip().lower())
+    return re.sub(r"\s+", " ", text)
+
+def is_cached(text) -> bool:
+    return get_geocode_cache().lookup(normalize_query(text), count = False) is not None
+
+def lookup_offline(text):
+    # local gazetteer if one was imported -> (lat, lon) or None
+    gazetteer = get_gazetteer()
+    with span("gazetteer", "geocode"):
+        place = gazetteer.resolve(text) if gazetteer is not None else None
+    return (place.lat, place.lon) if place is not None else None
+
+def needs_network(text) -> bool:
+    # would a final parse_coordinates have to ask nominatim
+    return parse_coordinates(text, final = False)[0] is None and not is_cached(text) and lookup_offline(text) is None
+
+def geocode(text):
+    # place name -> (lat, lon), (None, None) if there's no such place, None if nominatim couldn't be asked
+    query = normalize_query(text)
+    cache = get_geocode_cache()
+    entry = cache.lookup(query)
+    if entry is not None:
+        return entry[0], entry[1]
+
+    url = "https://nominatim.openstreetmap.org/search"
+    headers = { "User-Agent": "flakeframe/1.0" }
+    params = {
+        "q": query,
+        "limit": 1,
+        "format": "json"
+    }
+    with span("nominatim wait", "geocode"):
+        nominatim_limiter.acquire() # don't get banned from nominatim (again)
+    try:
+        with span("geocode", "net"):
+            resp = requests.get(url = url, params = params, headers = headers, timeout = 10)
+            response = resp.json()
+    except (requests.RequestException, ValueError):
+        return None
+
+    try:
+        lat, lon = float(response[0]["lat"]), float(response[0]["lon"])
+    except (LookupError, TypeError, ValueError): # nothing found
+        lat, lon = None, None
+    cache.put(query, [lat, lon, time.time()])
+    cache.save()
+    return lat, lon
+
+def geocode_stats() -> dict:
+    stats = get_geocode_cache().stats()
+    stats["limiter_wait"] = nominatim_limiter.waited
+    return stats
 
 def parse_coordinates(input_str: str, final: bool) -> (float, float):
     
@@ -43,23 +177,10 @@ def parse_coordinates(input_str: str, final: bool) -> (float, float):
             pass
     
     if final:
-        url = "https://nominatim.openstreetmap.org/search"
-        headers = { "User-Agent": "flakeframe/1.0" }
-        params = {
-            "q": input_str,
-            "limit": 1,
-            "format": "json"
-        }
-        resp = requests.get(url = url, params = params, headers = headers) # don't get banned from nominatim (again)
-        response = resp.json()
-        # TODO: global rate limit
-        
-        try:
-            lat = float(response[0]["lat"])
-            lon = float(response[0]["lon"])
-            return lat, lon, False
-        except Exception: # response failed for whatever reason
+        result = lookup_offline(input_str) or geocode(input_str)
+        if result is None or result[0] is None: # response failed for whatever reason
             return None, None, True
+        return result[0], result[1], False
     
     return None, None, False # no coord
 
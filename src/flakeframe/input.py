@@ -1,11 +1,18 @@
 # Input handler
 
+import atexit
+import codecs
 import sys
 import os
+import re
+import time
+from collections import deque
+from contextlib import contextmanager
 
 if sys.platform == "win32":
     import msvcrt
 else:
+    import select
     import termios
     import tty
 
@@ -18,54 +25,213 @@ KEY_ENTER = "enter"
 KEY_ESC = "esc"
 KEY_BACKSPACE = "backspace"
 
-def read_key():
-    if sys.platform == "win32":
-        ch = msvcrt.getch()
-        if ch in (b"\xe0", b"\x00"):
-            ch2 = msvcrt.getch()
-            if ch2 == b"H":
-                return KEY_UP
-            elif ch2 == b"P":
-                return KEY_DOWN
-            elif ch2 == b"M":
-                return KEY_RIGHT
-            elif ch2 == b"K":
-                return KEY_LEFT
-        elif ch == b"\r":
-            return KEY_ENTER
-        elif ch == b"\x1b":
-            return KEY_ESC
-        elif ch == b"\x08":
-            return KEY_BACKSPACE
-        elif ch.isascii() and ch.isprintable():
-            return ch.decode("utf-8").lower()
-        else:
-            return ch.decode("utf-8", errors = "ignore")
-        
-    else:
-        fd = sys.stdin.fileno()
-        old_settings = termios.tcgetattr(fd)
+ESC_DELAY = 0.025 # how long a lone ESC waits for the rest of an escape sequence
+ARROWS = {"A": KEY_UP, "B": KEY_DOWN, "C": KEY_RIGHT, "D": KEY_LEFT}
+
+def parse_keys(text, final = False):
+    # -> (keys, leftover) where leftover is an escape sequence cut off at the end, final says no more is coming
+    keys = []
+    i = 0
+    while i < len(text):
+        ch = text[i]
+        if ch == "\x1b":
+            if i + 1 == len(text):
+                if not final:
+                    break
+                keys.append(KEY_ESC)
+                i += 1
+                continue
+            intro = text[i + 1]
+            if intro in "[O": # CSI or SS3, arrows come as either depending on the terminal's mode
+                j = i + 2
+                if intro == "[":
+                    while j < len(text) and not "\x40" <= text[j] <= "\x7e":
+                        j += 1
+                if j >= len(text):
+                    if not final:
+                        break
+                    keys.append(KEY_ESC) # ESC then a real "[" typed fast, let the rest through as keys
+                    i += 1
+                    continue
+                key = ARROWS.get(text[j]) # modifiers like ctrl-arrow (1;5A) still move
+                if key:
+                    keys.append(key)
+                i = j + 1 # anything else (F keys, focus events, stray replies) is dropped whole
+                continue
+            keys.append(KEY_ESC) # ESC followed by a normal key, both count
+            i += 1
+            continue
+        if ch in "\r\n":
+            keys.append(KEY_ENTER)
+        elif ch in "\x7f\x08":
+            keys.append(KEY_BACKSPACE)
+        elif ch.isprintable():
+            keys.append(ch.lower())
+        i += 1
+    return keys, text[i:]
+
+def read_windows_key():
+    ch = msvcrt.getch()
+    if ch in (b"\xe0", b"\x00"):
+        return {b"H": KEY_UP, b"P": KEY_DOWN, b"M": KEY_RIGHT, b"K": KEY_LEFT}.get(msvcrt.getch())
+    if ch == b"\r":
+        return KEY_ENTER
+    if ch == b"\x1b":
+        return KEY_ESC
+    if ch == b"\x08":
+        return KEY_BACKSPACE
+    if ch.isascii() and ch.isprintable():
+        return ch.decode("utf-8").lower()
+    return ch.decode("utf-8", errors = "ignore") or None
+
+class InputSession:
+    # the terminal stays raw for as long as the UI runs instead of being switched for every key, and everything
+    # typed since the last look comes back at once so callers can squash repeats
+    def __init__(self):
+        self.saved = None # terminal settings to go back to, None while not active
+        self.fd = None
+        self.pending = deque() # keys read but not handed out yet
+        self.leftover = ""     # start of an escape sequence still waiting for its end
+        self.decoder = codecs.getincrementaldecoder("utf-8")(errors = "ignore")
+
+    def start(self):
+        if self.saved is not None or sys.platform == "win32" or not sys.stdin.isatty():
+            return
+        self.fd = sys.stdin.fileno()
+        self.saved = termios.tcgetattr(self.fd)
+        tty.setraw(self.fd)
+        # raw input, but output still turns \n into \r\n (the screen buffer counts on it) and ctrl-c still quits
+        mode = termios.tcgetattr(self.fd)
+        mode[1] |= termios.OPOST
+        mode[3] |= termios.ISIG
+        termios.tcsetattr(self.fd, termios.TCSANOW, mode)
+
+    def stop(self):
+        if self.saved is not None:
+            termios.tcsetattr(self.fd, termios.TCSADRAIN, self.saved)
+            self.saved = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+        return False
+
+    @contextmanager
+    def suspended(self):
+        # back to a normal terminal for a bit, e.g. around input()
+        active = self.saved is not None
+        self.stop()
         try:
-            tty.setraw(sys.stdin.fileno())
-            ch = os.read(fd, 1).decode("utf-8", errors = "ignore")
-            if ch == "\x1b":
-                ch += os.read(fd, 2).decode("utf-8", errors = "ignore")
-                if ch == "\x1b[A":
-                    return KEY_UP
-                if ch == "\x1b[B":
-                    return KEY_DOWN
-                if ch == "\x1b[C":
-                    return KEY_RIGHT
-                if ch == "\x1b[D":
-                    return KEY_LEFT
-                else:
-                    return KEY_ESC
-            elif ch == "\r" or ch == "\n":
-                return KEY_ENTER
-            elif ch == "\x7f":
-                return KEY_BACKSPACE
-            elif ch.isprintable():
-                return ch.lower()
-            
+            yield
         finally:
-            termios.tcsetattr(fd, termios.TCSADRAIN, old_settings)
\ No newline at end of file
+            if active:
+                self.start()
+
+    def wait_readable(self, timeout):
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        return bool(ready)
+
+    def fill(self, timeout):
+        # read whatever is there (waiting up to timeout for the first byte) into pending
+        if sys.platform == "win32":
+            deadline = None if timeout is None else time.monotonic() + timeout
+            while not msvcrt.kbhit():
+                if deadline is not None and time.monotonic() >= deadline:
+                    return
+                time.sleep(0.01)
+            while msvcrt.kbhit():
+                key = read_windows_key()
+                if key:
+                    self.pending.append(key)
+            return
+
+        self.start()
+        if self.saved is None: # not a terminal, nothing to read keys from
+            time.sleep(timeout if timeout is not None else 0.1)
+            return
+        if not self.wait_readable(timeout):
+            return
+        text = self.leftover
+        while True:
+            chunk = os.read(self.fd, 1024)
+            if not chunk:
+                break
+            text += self.decoder.decode(chunk)
+            if not self.wait_readable(0):
+                # a lone ESC or a sequence cut in half gets a moment for the rest to arrive, not forever
+                if parse_keys(text)[1]:
+                    if self.wait_readable(ESC_DELAY):
+                        continue
+                break
+        keys, self.leftover = parse_keys(text)
+        if self.leftover and not self.wait_readable(0):
+            more, self.leftover = parse_keys(self.leftover, final = True)
+            keys += more
+        self.pending.extend(keys)
+
+    def push(self, data):
+        # bytes something else read off the terminal that turned out to be keystrokes
+        keys, self.leftover = parse_keys(self.leftover + self.decoder.decode(data))
+        self.pending.extend(keys)
+
+    def read_keys(self, timeout = None):
+        # every key pressed since the last call, waits up to timeout for one if there are none ([] on timeout)
+        if not self.pending:
+            self.fill(timeout)
+        keys = list(self.pending)
+        self.pending.clear()
+        return keys
+
+    def read_key(self, timeout = None):
+        # one key, None on timeout
+        if not self.pending:
+            self.fill(timeout)
+        return self.pending.popleft() if self.pending else None
+
+session = InputSession()
+atexit.register(session.stop)
+
+def read_key(timeout = None):
+    # timeout in seconds, None if nothing was pressed by then
+    return session.read_key(timeout)
+
+def read_keys(timeout = None):
+    return session.read_keys(timeout)
+
+def query_terminal(request, pattern, timeout = 0.2):
+    # send an escape sequence and wait for the reply, returns the regex match or None
+    if sys.platform == "win32" or not sys.stdin.isatty() or not sys.stdout.isatty():
+        return None
+
+    fd = sys.stdin.fileno()
+    old_settings = termios.tcgetattr(fd)
+    try:
+        tty.setraw(fd)
+        sys.stdout.write(request)
+        sys.stdout.flush()
+
+        response = b""
+        match = None
+        deadline = time.monotonic() + timeout
+        while match is None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            ready, _, _ = select.select([fd], [], [], remaining)
+            if not ready:
+                break
+            chunk = os.read(fd, 64) # straight from the fd, sys.stdin's buffer would swallow it
+            if not chunk:
+                break
+            response += chunk
+            match = re.search(pattern, response)
+        # keys typed while we waited go back to the input session instead of getting lost
+        session.push(response[:match.start()] + response[match.end():] if match else response)
+        return match
+    except (OSError, termios.error):
+        return None
+    finally:
+        termios.tcsetattr(fd, termios.TCSADRAIN, old_settings)
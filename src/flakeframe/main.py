@@ -1,11 +1,19 @@
 # Main entry point
+import argparse
 import json
 import os
 import sys
 from configparser import ConfigParser
 from flakeframe.ui import SettingsUI
+from flakeframe.input import session
 from flakeframe.mapview import MapViewUI
+from flakeframe.dashboard import DashboardUI
 from flakeframe.theme import ThemeHandler, Theme, Asset, ThemeUI
+from flakeframe.tilecache import configure_tile_cache, MAX_IN_FLIGHT
+from flakeframe import trace
+from flakeframe.gazetteer import import_command, search_command, GAZETTEER_CLASSES
+from flakeframe.batch import batch_command, FORMATS
+from flakeframe.mbtiles import configure_tile_pack, pack_command, PACK_MAX_TILES
 
 CONFIG_FILE = "flakeframe.json" # TODO: check if distributors break this
 THEME_FILE = "flakeframe.themes"
@@ -18,17 +26,82 @@ def load_config(config):
         config["DEFAULT"]["units_precip"] = "mm"
         config["DEFAULT"]["units_temp"] = "°C"
         config["DEFAULT"]["show_map"] = "Yes"
+        config["DEFAULT"]["tile_cache_mb"] = "256"
+        config["DEFAULT"]["tile_ttl_days"] = "30"
+        config["DEFAULT"]["renderer"] = "img2unicode" # or native
+        config["DEFAULT"]["weather_ttl_minutes"] = "15"
+        config["DEFAULT"]["progressive"] = "Yes" # rough frame first, then the real one
+        config["DEFAULT"]["tile_glyphs"] = "Yes" # convert each map tile once and stitch frames from them
 
 def save_config(config):
     with open(CONFIG_FILE, "w") as configfile:
         config.write(configfile)
         
+def build_parser():
+    parser = argparse.ArgumentParser(prog = "flakeframe", description = "Command line weather app with a fancy map display")
+    parser.add_argument("--trace", metavar = "FILE", help = "record timing spans and write them as a chrome trace on exit")
+    commands = parser.add_subparsers(dest = "command")
+
+    imp = commands.add_parser("import-gazetteer", help = "build the offline place index from a GeoNames dump")
+    imp.add_argument("dump", help = "allCountries.txt / cities500.zip / ... from download.geonames.org/export/dump")
+    imp.add_argument("--output", help = "index file, defaults to the cache dir")
+    imp.add_argument("--classes", default = GAZETTEER_CLASSES, help = f"GeoNames feature classes to keep (default {GAZETTEER_CLASSES})")
+    imp.add_argument("--min-population", type = int, default = 0)
+    imp.set_defaults(func = import_command)
+
+    search = commands.add_parser("search", help = "look a place up in the offline index")
+    search.add_argument("query")
+    search.add_argument("--limit", type = int, default = 5)
+    search.set_defaults(func = search_command)
+
+    render = commands.add_parser("render", help = "write weather + map snapshots for a list of places, no terminal needed")
+    render.add_argument("sites", nargs = "*", help = "\"lat, lon\" or place names")
+    render.add_argument("-f", "--file", help = "more sites, one per line")
+    render.add_argument("-o", "--output", default = "snapshots", help = "directory for the files (default snapshots)")
+    render.add_argument("--format", default = "ansi,json", help = f"comma separated, any of {", ".join(FORMATS)} (default ansi,json)")
+    render.add_argument("--size", default = "120x40", help = "terminal size to render for (default 120x40)")
+    render.add_argument("--cell", help = "character cell size in pixels, e.g. 9x19")
+    render.add_argument("--zoom", type = int, default = 14)
+    render.add_argument("--renderer", choices = ["img2unicode", "native"], help = "defaults to the config's")
+    render.add_argument("--fast", action = "store_true", help = "quadrant glyphs instead of all block chars")
+    render.add_argument("-j", "--workers", type = int, help = "render processes (default one per core)")
+    render.set_defaults(func = batch_command)
+
+    pack = commands.add_parser("pack", help = "download a region's map tiles into an MBTiles file for offline use")
+    pack.add_argument("output", help = "the .mbtiles file, an existing one gets added to")
+    pack.add_argument("--bbox", required = True, help = "min_lon,min_lat,max_lon,max_lat")
+    pack.add_argument("--zooms", default = "10-15", help = "zoom level or range (default 10-15)")
+    pack.add_argument("--name", help = "name stored in the file")
+    pack.add_argument("-j", "--workers", type = int, default = MAX_IN_FLIGHT, help = f"parallel downloads (default {MAX_IN_FLIGHT})")
+    pack.add_argument("--max-tiles", type = int, default = PACK_MAX_TILES)
+    pack.set_defaults(func = pack_command)
+    return parser
+
 def entry():
+    args = build_parser().parse_args()
+    trace_file = args.trace or os.environ.get("FLAKEFRAME_TRACE")
+    if trace_file:
+        trace.start(trace_file) # open it in chrome://tracing or ui.perfetto.dev
     config = ConfigParser()
     load_config(config)
+    configure_tile_cache(
+        budget_mb = config["DEFAULT"].getfloat("tile_cache_mb", 256),
+        ttl_days  = config["DEFAULT"].getfloat("tile_ttl_days", 30)
+    )
+    configure_tile_pack(config["DEFAULT"].get("tile_pack"), config["DEFAULT"].get("tile_pack_fallback", "Yes") == "Yes")
+    if args.command:
+        sys.exit(args.func(args, config))
+    
     themes = ThemeHandler()
     themes.load_themefile(THEME_FILE)
     
+    try:
+        with session: # raw keyboard for the whole run instead of per key
+            ui_loop(config, themes)
+    except KeyboardInterrupt:
+        pass
+
+def ui_loop(config, themes):
     while True:
         ui = SettingsUI(config)
         result = ui.run()
@@ -44,7 +117,11 @@ def entry():
                 pass
             else:
                 print("this shouldn't happen")
-                input()
+                with session.suspended():
+                    input()
+            
+        elif result == "dashboard":
+            DashboardUI(config).run()
             
         elif result and isinstance(result, tuple):
             lat, lon = result
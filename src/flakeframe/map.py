@@ -1,138 +1,296 @@
 # Actual map rendering
 
 import staticmaps # py-staticmaps
-from img2unicode import FastGenericDualOptimizer, FastQuadDualOptimizer, HalfBlockDualOptimizer, Renderer
+from img2unicode import FastGenericDualOptimizer, FastQuadDualOptimizer, Renderer
 from PIL import Image, ImageDraw
-from io import BytesIO, StringIO
-import sys
+import math
 import shutil
+import threading
 import time
-import re
-import select
+from flakeframe.blocks import block_cells, GLYPH_W, GLYPH_H
+from flakeframe.cells import cells_from_arrays, grid_to_ansi
+from flakeframe.input import query_terminal
+from flakeframe.trace import span
+from flakeframe.tilecache import get_tile_downloader
+from flakeframe.mbtiles import get_pack_provider
 
 def textsize(self, text, font=None): # fixes a bug in PIL lol
     bbox = self.textbbox((0, 0), text, font=font)
     return bbox[2] - bbox[0], bbox[3] - bbox[1]
-    
+
 ImageDraw.ImageDraw.textsize = textsize
 
-def get_terminal_pixels(): # doesn't work :(
-    if not sys.stdout.isatty():
-        return 1920, 1080
-    
-    old_settings = None
-    fd = sys.stdin.fileno()
-    if sys.platform != "win32":
-        import termios
-        old_settings = termios.tcgetattr(fd)
-        
-    try:
-        if sys.platform != "win32":
-            import tty
-            tty.setraw(fd)
-        
-        sys.stdout.write("\x1b[14t")
-        sys.stdout.flush()
-        
-        response = b""
-        start = time.time()
-        print("sent")
-        
-        while time.time() - start < 0.5: # this is broken
-            print("reading")
-            ready, _, _ = select.select([sys.stdin], [], [], 0.5)
-            if ready:
-                chunk = sys.stdin.buffer.read(32)
-                if not chunk:
-                    break
-                response += chunk
-                if b't' in response:
-                    break
-            else:
-                break  # Timeout
-        
-        match = re.search(r'\x1b\[4;(\d+);(\d+)t', response)
-        if match:
-            height_px = int(match.group(1))
-            width_px  = int(match.group(2))
-            return width_px, height_px
-    
-    except Exception:
-        pass
-    finally:
-        if old_settings and sys.platform != "win32":
-            import termios
-            termios.tcsetattr(sys.stdin.fileno(), termios.TCSADRAIN, old_settings)
-    
-    return 1920, 1080 # fallback
-
-def render_map(lat, lon, zoom=14, debug = False, fast = False): # TODO: make dynamic/configurable later - Q/E keys?
-    start_time = time.perf_counter()
-    
-    context = staticmaps.Context()
-    context.set_tile_provider(staticmaps.tile_provider_ArcGISWorldImagery) # make configurable
-    center = staticmaps.create_latlng(lat, lon)
-    
-    context.set_center(center)
-    context.set_zoom(zoom)
-    setup_time = time.perf_counter()
-    
+# img2unicode converts 8x16 pixel blocks into one character (GLYPH_W x GLYPH_H), so does blocks.py
+DEFAULT_CELL = (9, 19) # guess for when the terminal won't tell us its cell size
+
+_cell_size = None
+_optimizers = threading.local() # img2unicode optimizers take ~0.1s to build, each render thread keeps its own
+
+class RenderCancelled(Exception):
+    pass # raised between stages once a render isn't wanted anymore
+
+def get_terminal_pixels():
+    # size of the text area in pixels (CSI 14t)
+    match = query_terminal("\x1b[14t", rb"\x1b\[4;(\d+);(\d+)t")
+    if match and int(match.group(1)) and int(match.group(2)):
+        return int(match.group(2)), int(match.group(1))
+
     cols, rows = shutil.get_terminal_size()
-    max_w = cols - 2
-    reserve_lines = 2
-    available_lines = max(10, rows - reserve_lines)
-    
-    char_aspect = 2.1
-    target_aspect = max_w / (available_lines * char_aspect)
-    
-    base_max = 380
-    if target_aspect > 1:
-        base_w = base_max
-        base_h = max(100, int(base_max / target_aspect))
+    return cols * DEFAULT_CELL[0], rows * DEFAULT_CELL[1] # fallback
+
+def get_cell_size(query = True):
+    global _cell_size
+    if _cell_size is not None:
+        return _cell_size
+    if not query or threading.current_thread() is not threading.main_thread():
+        return DEFAULT_CELL # only the main thread may touch stdin
+    _cell_size = query_cell_size()
+    return _cell_size
+
+def query_cell_size():
+    # pixel size of one character cell, CSI 16t asks directly, CSI 14t / grid size is the backup
+    cell = None
+    match = query_terminal("\x1b[16t", rb"\x1b\[6;(\d+);(\d+)t")
+    if match and int(match.group(1)) and int(match.group(2)):
+        cell = int(match.group(2)), int(match.group(1))
     else:
-        base_h = base_max
-        base_w = max(150, int(base_max / target_aspect))
-    
-    image = context.render_pillow(base_w, base_h)
-    maprend_time = time.perf_counter()
-    # term_w_px, term_h_px = get_terminal_pixels()
-    
-    final_w = max_w * 9
-    final_h = available_lines * 19
-    
-    image = image.resize((final_w, final_h), resample = Image.LANCZOS)
-    resize_time = time.perf_counter()
-
-    columns, rows = shutil.get_terminal_size()
-    max_w = columns - 2
-    
-    if fast:
-        optimizer = FastQuadDualOptimizer()           # quad block chars
+        match = query_terminal("\x1b[14t", rb"\x1b\[4;(\d+);(\d+)t")
+        if match and int(match.group(1)) and int(match.group(2)):
+            cols, rows = shutil.get_terminal_size()
+            cell = int(match.group(2)) / cols, int(match.group(1)) / rows
+    return cell or DEFAULT_CELL
+
+def reset_cell_size():
+    # ask again, changing the font size resizes the terminal too, main thread only
+    # swapped in whole so render workers never see it unset
+    global _cell_size
+    _cell_size = query_cell_size()
+    return _cell_size
+
+def set_cell_size(cell):
+    # for when there's no terminal to ask, e.g. rendering from cron
+    global _cell_size
+    _cell_size = cell
+
+def cell_geometry(cols, lines, cell):
+    # -> (source size, glyph grid size) for a cols x lines block of characters
+    cell_w, cell_h = cell
+    grid = (cols * GLYPH_W, lines * GLYPH_H)                     # exactly what img2unicode eats
+    source = (grid[0], round(lines * cell_h * GLYPH_W / cell_w)) # square map pixels at the same horizontal scale
+    return source, grid
+
+def map_geometry(size, cell):
+    # -> (columns, lines, source size, glyph grid size)
+    cols, rows = size
+    max_w = cols - 2
+    lines = max(6, rows - 6)
+    source, grid = cell_geometry(max_w, lines, cell)
+    return max_w, lines, source, grid
+
+def row_height(cell):
+    # map pixels covered by one row of characters
+    return GLYPH_W * cell[1] / cell[0]
+
+def latlon_to_world(lat, lon, zoom):
+    # web mercator pixel coords at this zoom, 256px tiles like staticmaps
+    world = 256 * 2 ** zoom
+    siny = min(max(math.sin(math.radians(lat)), -0.9999), 0.9999)
+    x = (lon + 180) / 360 * world
+    y = (0.5 - math.log((1 + siny) / (1 - siny)) / (4 * math.pi)) * world
+    return x, y
+
+def world_to_latlon(x, y, zoom):
+    world = 256 * 2 ** zoom
+    y = min(max(y, 0), world)
+    lon = (x / world * 360) % 360 - 180
+    lat = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y / world))))
+    return lat, lon
+
+def offset_latlon(lat, lon, zoom, dx, dy):
+    # move a point by dx/dy map pixels at this zoom
+    x, y = latlon_to_world(lat, lon, zoom)
+    return world_to_latlon(x + dx, y + dy, zoom)
+
+def pick_resampler(src, dst):
+    # the two only differ by the cell aspect, nothing worth lanczos
+    if src == dst:
+        return None
+    ratio = dst[1] / src[1]
+    if ratio < 0.5:
+        return Image.BOX
+    return Image.BILINEAR
+
+def attribution_height(provider):
+    text = provider.attribution()
+    if not text:
+        return 0
+    draw = ImageDraw.Draw(Image.new("RGB", (1, 1)))
+    return draw.textsize(text)[1] + 4 # staticmaps puts a 2px margin around it
+
+def optimizer_name(fast, native):
+    if native:
+        return "native-quad" if fast else "native-half"
+    return "quad" if fast else "block"
+
+def view_tiles(lat, lon, zoom, width, height, tile_size = 256):
+    # the same tiles staticmaps' pillow renderer will ask for
+    trans = staticmaps.Transformer(width, height, zoom, staticmaps.create_latlng(lat, lon), tile_size)
+    tiles = []
+    for yy in range(trans.tiles_y()):
+        y = trans.first_tile_y() + yy
+        if y < 0 or y >= trans.number_of_tiles():
+            continue
+        for xx in range(trans.tiles_x()):
+            tiles.append(((trans.first_tile_x() + xx) % trans.number_of_tiles(), y))
+    return tiles
+
+def base_provider():
+    return staticmaps.tile_provider_ArcGISWorldImagery # make configurable
+
+def tile_provider():
+    # a configured offline pack in front of the online tiles
+    return get_pack_provider(base_provider()) or base_provider()
+
+def prefetch_maps(centres, zoom, source):
+    # tiles for a bunch of views in one go, renders afterwards only read the store
+    provider = tile_provider()
+    strip = attribution_height(provider)
+    tiles = set()
+    for lat, lon in centres:
+        tiles.update(view_tiles(lat, lon, zoom, source[0], source[1] + strip, provider.tile_size()))
+    downloader = get_tile_downloader()
+    downloader.prefetch(provider, zoom, sorted(tiles))
+    downloader.store.flush()
+    return len(tiles)
+
+def compose_source(lat, lon, zoom, source, cancelled = None, timings = None):
+    # tiles -> pillow image of the map at source size, square pixels
+    start = time.perf_counter()
+    context = staticmaps.Context()
+    provider = tile_provider()
+    context.set_tile_provider(provider)
+    downloader = get_tile_downloader()
+    context.set_tile_downloader(downloader)
+    context.set_center(staticmaps.create_latlng(lat, lon))
+    context.set_zoom(zoom)
+
+    # the watermark goes in an extra strip below the map that gets cropped off
+    strip = attribution_height(provider)
+    with span("tiles", "net", zoom = zoom):
+        downloader.prefetch(provider, zoom, view_tiles(lat, lon, zoom, source[0], source[1] + strip, provider.tile_size()))
+    with span("pillow render", "render"):
+        image = context.render_pillow(source[0], source[1] + strip)
+    downloader.store.flush()
+    if timings is not None:
+        timings["map render"] = time.perf_counter() - start
+    if cancelled and cancelled():
+        raise RenderCancelled()
+    return image.convert("RGB").crop((0, 0, source[0], source[1]))
+
+def crop_center(image, size):
+    # the middle size pixels of a bigger composed image, same centre so same place
+    w, h = image.size
+    if (w, h) == tuple(size):
+        return image
+    left, top = (w - size[0]) // 2, (h - size[1]) // 2
+    return image.crop((left, top, left + size[0], top + size[1]))
+
+def fit_source(image, source, grid, cancelled = None, timings = None):
+    # composed image -> pillow image at the glyph grid size
+    start = time.perf_counter()
+    with span("resize", "render"):
+        image = crop_center(image, source)
+        resampler = pick_resampler(source, grid)
+        if resampler is not None:
+            image = image.resize(grid, resample = resampler)
+    if cancelled and cancelled():
+        raise RenderCancelled()
+
+    if timings is not None:
+        timings["resize"] = time.perf_counter() - start
+        timings["resampler"] = "skipped" if resampler is None else Image.Resampling(resampler).name
+    return image
+
+def compose_map(lat, lon, zoom, source, grid, cancelled = None, timings = None):
+    # tiles -> pillow image at the glyph grid size
+    return fit_source(compose_source(lat, lon, zoom, source, cancelled, timings), source, grid, cancelled, timings)
+
+def get_optimizer(fast):
+    built = getattr(_optimizers, "built", None)
+    if built is None:
+        built = _optimizers.built = {}
+    if fast not in built:
+        built[fast] = FastQuadDualOptimizer() if fast else FastGenericDualOptimizer("block") # quad / all block chars
+    return built[fast]
+
+def convert_map(image, cols, fast = False, native = False, timings = None):
+    # pillow image -> grid of character cells
+    start = time.perf_counter()
+    with span("glyphs", "render", optimizer = optimizer_name(fast, native), cols = cols):
+        if native:
+            rows = block_cells(image, quad = fast) # numpy half/quadrant blocks
+        else:
+            optimizer = get_optimizer(fast)
+            renderer = Renderer(default_optimizer = optimizer, max_w = cols)
+            chars, fgs, bgs = renderer.render_numpy(image, optimizer = optimizer)
+            rows = cells_from_arrays(chars, fgs, bgs)
+
+    if timings is not None:
+        timings["glyphs"] = time.perf_counter() - start
+    return rows
+
+def quick_frame(image, cols) -> str:
+    # stand-in while the real glyph pass runs, native quadrants are an order of magnitude cheaper
+    return grid_to_ansi(convert_map(image, cols, fast = True, native = True))
+
+def zoom_in_image(image, steps = 1):
+    # approximate a closer zoom from an image we already have, centre crop blown back up
+    w, h = image.size
+    scale = 2 ** steps
+    box = (w * (1 - 1 / scale) / 2, h * (1 - 1 / scale) / 2, w * (1 + 1 / scale) / 2, h * (1 + 1 / scale) / 2)
+    return image.resize((w, h), Image.BILINEAR, box = box)
+
+def render_cells(lat, lon, zoom, cols, lines, fast = False, native = False, cancelled = None, timings = None):
+    source, grid = cell_geometry(cols, lines, get_cell_size())
+    image = compose_map(lat, lon, zoom, source, grid, cancelled, timings)
+    return convert_map(image, cols, fast, native, timings)
+
+def render_map(lat, lon, zoom=14, debug = False, fast = False, size = None, cancelled = None, native = False, on_image = None, timings = None,
+               composed = None, on_composed = None, overlay = None): # TODO: make dynamic/configurable later - Q/E keys?
+    start_time = time.perf_counter()
+
+    size = size or shutil.get_terminal_size()
+    cell = get_cell_size()
+    max_w, lines, source, grid = map_geometry(size, cell)
+    timings = {} if timings is None else timings
+
+    # composed: an earlier compose of this place at least source big, e.g. from before a terminal resize
+    if composed is None:
+        composed = compose_source(lat, lon, zoom, source, cancelled, timings)
+        if on_composed is not None:
+            on_composed(composed)
     else:
-        optimizer = FastGenericDualOptimizer("block") # all block chars
-    
-    renderer = Renderer(default_optimizer = optimizer, max_w = max_w)
-    setrend_time = time.perf_counter()
-    
-    out = StringIO()
-    renderer.render_terminal(image, out, optimizer = optimizer)
+        timings["map render"] = 0.0
+    image = fit_source(composed, source, grid, cancelled, timings)
+    if overlay is not None:
+        image = overlay(image, source) # e.g. weather colours, painted before glyphs so they blend into the map
+    if on_image is not None:
+        on_image(image) # gets a look before the slow glyph pass, e.g. for a preview
+        if cancelled and cancelled():
+            raise RenderCancelled()
+    rows = convert_map(image, max_w, fast, native, timings)
+    with span("ansi", "render"):
+        data = grid_to_ansi(rows)
     final_time = time.perf_counter()
-    
-    data = out.getvalue()
-    lines = data.splitlines()
-    data = "\n".join(lines[:-4]) # trim last 4 lines (provider watermark)
-    
-    # print("\x1b[H\x1b[2J")
-    
+
     if debug:
         print("\x1b[H\x1b[2J")
         print(data)
         print("lat/long: ", lat, lon, "\nzoom: ", zoom)
-        print("Setup:       ", setup_time - start_time)
-        print("Map render:  ", maprend_time - setup_time)
-        print("Resizing:    ", resize_time - maprend_time)
-        print("Rend setup:  ", setrend_time - resize_time)
-        print("img2unicode: ", final_time - setrend_time)
+        print("Cell px:     ", cell, "grid:", grid, "source:", source)
+        print("Map render:  ", timings["map render"])
+        print("Resizing:    ", timings["resize"], timings["resampler"])
+        print("Glyphs:      ", timings["glyphs"], optimizer_name(fast, native))
         print("Elapsed:     ", final_time - start_time)
-    
-    return data
\ No newline at end of file
+
+    return data
@@ -1,82 +1,201 @@
-import sys
-import shutil
-import re
-from datetime import date, datetime, time
-from flakeframe.input import read_key
-from flakeframe.map import render_map
-from flakeframe.ui import clear, get_terminal_size, display_width
-from flakeframe.weather import fetch_weather, WEATHER_CODES
+import math
+import signal
+import threading
+from time import monotonic
+from flakeframe.cache import LRUCache
+from flakeframe.input import read_keys
+from flakeframe.cells import grid_to_ansi
+from flakeframe.geocode import geocode_stats
+from flakeframe.map import render_map, render_cells, get_cell_size, reset_cell_size, optimizer_name, map_geometry, row_height, offset_latlon, latlon_to_world, quick_frame, zoom_in_image, GLYPH_W
+from flakeframe.overlay import OVERLAYS, grid_cache, grid_ttl, overlay_grid, paint_overlay, legend
+from flakeframe.screen import screen
+from flakeframe.tilegrid import TILE_PX, tile_lines, tiled_cells, tiled_preview, glyph_cache
+from flakeframe import trace
+from flakeframe.prefetch import get_render_pool, PRIORITY_VISIBLE, PRIORITY_SPECULATIVE
+from flakeframe.ui import get_terminal_size, display_width, display_center, is_saved, save_location, remove_location
+from flakeframe.weather import fetch_weather
+
+# finished ansi frames, shared between map views so reopening a place is instant too
+frame_cache = LRUCache(32)
+# composed map images before glyphs, only for previews so a handful is plenty
+image_cache = LRUCache(6)
+# composed images at source size by place, a resize crops the new view out of one instead of composing again
+composed_cache = LRUCache(3)
+# overlay frame key -> when the weather painted on it was fetched, the frame goes stale with it
+overlay_fetched = {}
+
+CANVAS_SCALE = 2     # pan canvas is this many viewports wide and tall
+CANVAS_MARGIN = 0.375 # start re-centring once the view is less than this many viewports from the edge
+RESIZE_DEBOUNCE = 0.15 # seconds the size has to hold still before re-rendering, dragging a window edge resizes a lot
+PAN_KEYS = {"w": (0, -1), "up": (0, -1), "s": (0, 1), "down": (0, 1), "a": (-1, 0), "left": (-1, 0), "d": (1, 0), "right": (1, 0)}
 
 def in_inches(num) -> float:
     return round(num * 0.0393701, 2)
 
+class Canvas:
+    # an oversize block of map cells around a centre, pans just move a window over it
+    def __init__(self, lat, lon, zoom, size, rows, row_px):
+        self.lat = lat
+        self.lon = lon
+        self.zoom = zoom
+        self.size = size
+        self.rows = rows
+        self.row_px = row_px # world pixels per row, tiled canvases round it so tiles stack
+        self.w = len(rows[0]) if rows else 0
+        self.h = len(rows)
+        # top left in whole cells of the world, rounded the way tilegrid.grid_window does
+        cx, cy = latlon_to_world(lat, lon, zoom)
+        self.left = round(cx / GLYPH_W - self.w / 2)
+        self.top = round(cy / row_px - self.h / 2)
+        
+    def window_pos(self, lat, lon, view_w, view_h):
+        # top left of a view centred on lat/lon, in canvas cells
+        vx, vy = latlon_to_world(lat, lon, self.zoom)
+        return round(vx / GLYPH_W - view_w / 2) - self.left, round(vy / self.row_px - view_h / 2) - self.top
+        
+    def covers(self, lat, lon, view_w, view_h, margin = 0):
+        x, y = self.window_pos(lat, lon, view_w, view_h)
+        mx, my = int(view_w * margin), int(view_h * margin)
+        return mx <= x and x + view_w <= self.w - mx and my <= y and y + view_h <= self.h - my
+        
+    def window(self, lat, lon, view_w, view_h) -> str:
+        x, y = self.window_pos(lat, lon, view_w, view_h)
+        return grid_to_ansi(self.rows, x, y, view_w, view_h)
+
 class MapViewUI:
     def __init__(self, lat, lon, config):
         self.lat = lat
         self.lon = lon
+        self.center = (lat, lon) # where the map is looking, moves when panning
         self.config = config
         self.zoom = 14
+        self.canvas = None
+        self.next_canvas = None
+        self.fast = False
+        self.native = self.config["DEFAULT"].get("renderer", "img2unicode") == "native"
+        self.debug = self.config["DEFAULT"].get("debug", "No") == "Yes"
+        self.progressive = self.config["DEFAULT"].get("progressive", "Yes") == "Yes"
+        self.tiled = self.config["DEFAULT"].get("tile_glyphs", "Yes") == "Yes" # stitch frames from per-tile glyphs
         self.map_data = None
-        self.weather_data = fetch_weather(self.lat, self.lon, self.config)
+        frame_cache.maxsize = self.config["DEFAULT"].getint("frame_cache_size", 32)
+        glyph_cache.maxsize = self.config["DEFAULT"].getint("glyph_cache_size", glyph_cache.maxsize)
+        get_cell_size() # ask the terminal now, render workers aren't allowed to read stdin
+        self.map_key = None
+        self.map_future = None
+        self.map_error = None # why the frame on screen failed, shown instead of the map
+        self.preview = None   # (key, rough frame) handed over by a render worker, poll() decides if it still fits
+        self.weather_data = None
+        self.weather_loading = False
+        self.changed = threading.Event() # set by background work that wants a redraw
+        self.show_trace = False
+        self.overlay = None # one of OVERLAYS painted over the map
+        self.overlay_force = False # [r] was pressed, the next overlay grid skips the weather cache
+        self.size = tuple(get_terminal_size())
+        self.resize_at = None # when the size last changed, None once it's been dealt with
         
-    def show_loading(self):
-        clear()
-        term_w, term_h = get_terminal_size()
-        msg = "Loading... ☺"
-        x = (term_w - len(msg)) // 2
-        y = term_h // 2
-        sys.stdout.write(f"\x1b[{y};{x}H{msg}")
-        sys.stdout.flush()
+    def load_weather(self, force = False):
+        # weather comes in on its own thread so it never waits on the map, or the other way round
+        self.weather_loading = True
+        def worker():
+            try:
+                self.weather_data = fetch_weather(self.lat, self.lon, self.config, force = force, on_update = self.weather_updated) or self.weather_data
+            finally:
+                self.weather_loading = False
+                self.changed.set()
+        threading.Thread(target = worker, daemon = True).start()
+        
+    def weather_updated(self, data):
+        # stale weather got refreshed in the background
+        if data is not None:
+            self.weather_data = data
+            self.changed.set()
         
     def draw_ui(self):
-        clear()
+        screen.begin()
+        term_w, term_h = get_terminal_size()
         if self.config["DEFAULT"]["show_map"] in ["Yes", "Only"]:
-            sys.stdout.write(self.map_data + "\n")
+            if self.map_data is not None:
+                screen.write(self.map_data + "\n")
+            else:
+                msg = f"Map failed ({self.map_error}), [r] to retry" if self.map_error else "Loading map... ☺"
+                screen.write(f"\x1b[{term_h - 3};{(term_w - display_width(msg)) // 2}H{msg}")
             
         if self.config["DEFAULT"]["show_map"] == ["Only"]:
-            sys.stdout.flush()
+            screen.present()
             return
         
-        term_w, term_h = get_terminal_size()
-        rsc = "\x1b[0m"
-        
         # weather box
         box_x = (term_w - 38) // 2
         box_y = 2
+        if self.weather_data is not None:
+            self.draw_weather(box_x, box_y)
+        else:
+            msg = "Loading weather..." if self.weather_loading else "Weather unavailable :("
+            screen.write(f"\x1b[{box_y    };{box_x}H ╭──────────────────────────────────────╮ ")
+            screen.write(f"\x1b[{box_y + 1};{box_x}H │{display_center(f"{self.lat:+.2f}, {self.lon:+.2f}", 38)}│ ")
+            screen.write(f"\x1b[{box_y + 2};{box_x}H ╞══════════════════════════════════════╡ ")
+            screen.write(f"\x1b[{box_y + 3};{box_x}H │{display_center(msg, 38)}\x1b[0m│ ")
+            screen.write(f"\x1b[{box_y + 4};{box_x}H ╰──────────────────────────────────────╯ ")
+        
+        # controls
+        save = "unsave" if is_saved(self.config, self.lat, self.lon) else "save"
+        controls = f"\x1b[38;5;86m< \x1b[32m[+/-]\x1b[38;5;86m zoom | \x1b[32m[wasd]\x1b[38;5;86m pan | \x1b[32m[r]\x1b[38;5;86meload | \x1b[32m[f]\x1b[38;5;86m {save} | \x1b[32m[o]\x1b[38;5;86mverlay | \x1b[32m[esc/q]\x1b[38;5;86m back >"
+        controls_visw = display_width(controls)
+        controls_x = term_w - controls_visw - 4
+        controls_y = term_h - 1
+        screen.write(f"\x1b[{controls_y};{controls_x}H{controls}")
+        if self.overlay is not None:
+            screen.write(f"\x1b[{controls_y - 1};2H{legend(self.overlay)}")
+        
+        if self.show_trace:
+            self.draw_trace(term_h)
+        
+        if self.debug:
+            st = frame_cache.stats()
+            geo = geocode_stats()
+            screen.write(f"\x1b[{controls_y};2H\x1b[38;5;86mframes {st["hits"]} hit / {st["misses"]} miss ({st["size"]}/{st["maxsize"]}) | "
+                         f"geocode {geo["hits"]} hit / {geo["misses"]} miss, {geo["limiter_wait"]:.1f}s waiting\x1b[0m")
+        screen.present()
+        
+    def draw_weather(self, box_x, box_y):
+        rsc = "\x1b[0m"
         c_time = self.weather_data.current.time.strftime("%I:%M %p")
         c_tempcol = "\x1b[0;38;2;255;100;0m" if self.weather_data.current.temperature > 0 else "\x1b[0;38;2;0;128;255m"
         inches = self.config["DEFAULT"]["units_precip"] == "inch"
         
-        sys.stdout.write(f"\x1b[{box_y    };{box_x}H ╭──────────────────────────────────────╮ ")
-        sys.stdout.write(f"\x1b[{box_y + 1};{box_x}H │      {self.lat:+.2f}, {self.lon:+.2f} @ {c_time}       │ ")
-        sys.stdout.write(f"\x1b[{box_y + 2};{box_x}H ╞══════╤═══════════════════════════════╡ ")
+        screen.write(f"\x1b[{box_y    };{box_x}H ╭──────────────────────────────────────╮ ")
+        screen.write(f"\x1b[{box_y + 1};{box_x}H │      {self.lat:+.2f}, {self.lon:+.2f} @ {c_time}       │ ")
+        screen.write(f"\x1b[{box_y + 2};{box_x}H ╞══════╤═══════════════════════════════╡ ")
         
         condlen = display_width(self.weather_data.current.condition)
         cond = self.weather_data.current.condition + (" " * (29 - condlen))
         
-        sys.stdout.write(f"\x1b[{box_y + 3};{box_x}H │ {c_tempcol}{int(self.weather_data.current.temperature):3}°{rsc} │ {cond} │ ")
-        sys.stdout.write(f"\x1b[{box_y + 4};{box_x}H ├──────┴────────────┬──────────────────┤ ")
+        screen.write(f"\x1b[{box_y + 3};{box_x}H │ {c_tempcol}{int(self.weather_data.current.temperature):3}°{rsc} │ {cond} │ ")
+        screen.write(f"\x1b[{box_y + 4};{box_x}H ├──────┴────────────┬──────────────────┤ ")
         
         curr_precip = f"{self.weather_data.current.precipitation}mm" if not inches else f"{self.weather_data.current.precipitation}in"
-        sys.stdout.write(f"\x1b[{box_y + 5};{box_x}H │ {self.weather_data.current.wind_direction_deg:>3}° ({self.weather_data.current.wind_direction_str}) {self.weather_data.current.wind_speed_kmh:>4.0f}km/h │ {f"{curr_precip} precip":16} │ ")
-        sys.stdout.write(f"\x1b[{box_y + 6};{box_x}H ╞══════╤════════════╧══════════════════╡ ")
+        screen.write(f"\x1b[{box_y + 5};{box_x}H │ {self.weather_data.current.wind_direction_deg:>3}° ({self.weather_data.current.wind_direction_str}) {self.weather_data.current.wind_speed_kmh:>4.0f}km/h │ {f"{curr_precip} precip":16} │ ")
+        screen.write(f"\x1b[{box_y + 6};{box_x}H ╞══════╤════════════╧══════════════════╡ ")
         
         pc_units = "mm" if not inches else "in"
         
-        for i in range(5):
-            current_time = datetime.now().hour
-            
-            h = self.weather_data.hourly[current_time + i + 1]
+        hours = self.weather_data.hourly.next_hours(5)
+        for i, h in enumerate(hours):
             h_time = h.time.strftime("%I%p").lower()
             h_tempcol = "\x1b[0;38;2;255;100;0m" if h.temperature > 0 else "\x1b[0;38;2;0;128;255m"
-            h_temp = f"{h_tempcol}{int(h.temperature):3}°{rsc}"
-            h_precip = f"{h.precipitation:.2f}{pc_units}" if not inches else f"{h.precipitation:.0f}{pc_units}"
+            h_temp = f"{h_tempcol}{int(h.temperature):3}°{rsc}" if not math.isnan(h.temperature) else " --°" # null hours come through as nan
+            if math.isnan(h.precipitation):
+                h_precip = f"--{pc_units}"
+            else:
+                h_precip = f"{h.precipitation:.2f}{pc_units}" if not inches else f"{h.precipitation:.0f}{pc_units}"
             h_line = f" {h_time} ┆ {h_temp} {h.condition}, {h_precip} "
             linelen = display_width(h_line)
             h_line = h_line + (" " * (38 - linelen))
-            sys.stdout.write(f"\x1b[{box_y + 7 + i};{box_x}H │{h_line:<38}│ ")
+            screen.write(f"\x1b[{box_y + 7 + i};{box_x}H │{h_line:<38}│ ")
+        for i in range(len(hours), 5): # forecast ran out, old cached data
+            screen.write(f"\x1b[{box_y + 7 + i};{box_x}H │{" " * 38}│ ")
             
-        sys.stdout.write(f"\x1b[{box_y + 12};{box_x}H ╞══════╪═══════════════════════════════╡ ")
+        screen.write(f"\x1b[{box_y + 12};{box_x}H ╞══════╪═══════════════════════════════╡ ")
         
         for i in range(5):
             d = self.weather_data.daily[i+1]
@@ -89,35 +208,343 @@ class MapViewUI:
             d_line = f" {d_day}  ┆ {d_low} to {d_high}°, {d.condition}, {d_precip} "
             linelen = display_width(d_line)
             d_line = d_line + (" " * (38 - linelen))
-            sys.stdout.write(f"\x1b[{box_y + 13 + i};{box_x}H │{d_line:<38}│ ")
+            screen.write(f"\x1b[{box_y + 13 + i};{box_x}H │{d_line:<38}│ ")
         
-        sys.stdout.write(f"\x1b[{box_y + 18};{box_x}H ╰──────┴───────────────────────────────╯ ")
+        screen.write(f"\x1b[{box_y + 18};{box_x}H ╰──────┴───────────────────────────────╯ ")
         
-        # controls
-        controls = "\x1b[38;5;86m< \x1b[32m[+/-]\x1b[38;5;86m zoom | \x1b[32m[r]\x1b[38;5;86meload | \x1b[32m[esc/q]\x1b[38;5;86m back >"
-        controls_visw = display_width(controls)
-        controls_x = term_w - controls_visw - 4
-        controls_y = term_h - 1
-        sys.stdout.write(f"\x1b[{controls_y};{controls_x}H{controls}")
-        sys.stdout.flush()
+    def draw_trace(self, term_h):
+        # where the time went for the frame on screen, plus the latest of everything around it
+        lines = []
+        root = trace.last_root("frame", key = str(self.map_key))
+        if root is not None:
+            args, duration, children = root
+            lines.append(f"frame {duration / 1e6:8.1f} ms  {args.get("optimizer", "")}")
+            lines += [f"  {name:14} {ms:8.1f}" for name, ms in trace.breakdown(children).items()]
+        else:
+            lines.append("frame      cached" if self.map_future is None else "frame   rendering")
+        for name in ("present", "write", "weather fetch", "weather parse", "geocode"):
+            other = trace.last_root(name)
+            if other is not None:
+                extra = f"  {other[0]["bytes"] / 1024:.1f}KB" if "bytes" in other[0] else ""
+                lines.append(f"{name:16} {other[1] / 1e6:8.1f}{extra}")
+        y = term_h - 2 - len(lines)
+        for i, line in enumerate(lines):
+            screen.write(f"\x1b[{y + i};2H\x1b[0;48;5;235;38;5;250m {line:<30} \x1b[0m")
         
     def run(self):
+        # weather and the first frame load side by side, whichever lands first gets drawn first
+        self.load_weather()
         self.refresh_map()
+        # SIGWINCH just wakes the loop up, poll() works out the new size (and does it alone where there's no signal)
+        winch = getattr(signal, "SIGWINCH", None)
+        if winch is not None:
+            old = signal.getsignal(winch)
+            signal.signal(winch, lambda *_: self.changed.set())
+        try:
+            self.loop()
+        finally:
+            if winch is not None:
+                signal.signal(winch, old if old is not None else signal.SIG_DFL)
+            
+    def loop(self):
         while True:
-            key = read_key()
-            if key in ("+", "="):
-                self.zoom = min(18, self.zoom + 1)
+            keys = read_keys(timeout = 0.05)
+            if not keys:
+                self.poll()
+                continue
+            # a held key comes in as a burst, only where the burst ends up gets rendered
+            zoom = self.zoom
+            dx = dy = 0
+            for key in keys:
+                if key in ("+", "="):
+                    zoom = min(18, zoom + 1)
+                elif key == "-":
+                    zoom = max(1, zoom - 1)
+                elif key in PAN_KEYS:
+                    dx, dy = dx + PAN_KEYS[key][0], dy + PAN_KEYS[key][1]
+                elif self.handle_key(key):
+                    return
+            if zoom != self.zoom:
+                if dx or dy:
+                    self.move_center(dx, dy)
+                self.zoom = zoom
                 self.refresh_map()
-            elif key == "-":
-                self.zoom = max(1, self.zoom - 1)
+            elif dx or dy:
+                self.pan(dx, dy)
+            
+    def handle_key(self, key) -> bool:
+        # everything but zoom and pan, True means leave
+        if key == "r":
+            self.load_weather(force = True)
+            if self.overlay is not None:
+                self.forget_overlay()
+            if self.map_error is not None or self.overlay is not None:
                 self.refresh_map()
-            elif key == "r":
-                self.weather_data = fetch_weather(self.lat, self.lon, self.config)
-                self.draw_ui()
-            elif key in ("esc", "q"):
-                return
+            self.draw_ui()
+        elif key == "t":
+            # the overlay needs spans, tracing stays on afterwards if --trace turned it on
+            self.show_trace = not self.show_trace
+            if self.show_trace:
+                trace.enable()
+            elif trace.export_path is None:
+                trace.disable()
+            self.draw_ui()
+        elif key == "f":
+            # saved locations show up on the dashboard
+            if is_saved(self.config, self.lat, self.lon):
+                remove_location(self.config, self.lat, self.lon)
+            else:
+                save_location(self.config, self.lat, self.lon)
+            self.draw_ui()
+        elif key == "o":
+            # off -> precip -> temp -> off
+            modes = (None,) + OVERLAYS
+            self.overlay = modes[(modes.index(self.overlay) + 1) % len(modes)]
+            self.refresh_map()
+        elif key in ("esc", "q"):
+            if self.map_future is not None:
+                get_render_pool().demote(self.map_key)
+            get_render_pool().cancel_speculative()
+            return True
+        return False
+            
+    def frame_key(self, zoom = None):
+        size = tuple(get_terminal_size())
+        optimizer = optimizer_name(self.fast, self.native)
+        if self.overlay is not None:
+            optimizer += f"+{self.overlay}" # a different picture, so a different frame
+        lat, lon = self.center
+        return (round(lat, 6), round(lon, 6), self.zoom if zoom is None else zoom, size, optimizer)
+        
+    def view_size(self, size):
+        max_w, lines, _, _ = map_geometry(size, get_cell_size())
+        return max_w, lines
+        
+    def move_center(self, dx, dy):
+        # dx/dy in pan steps, an eighth of the view each
+        view_w, view_h = self.view_size(tuple(get_terminal_size()))
+        step_x, step_y = max(1, view_w // 8), max(1, view_h // 8)
+        self.center = offset_latlon(*self.center, self.zoom, dx * step_x * GLYPH_W, dy * step_y * row_height(get_cell_size()))
+        
+    def pan(self, dx, dy):
+        size = tuple(get_terminal_size())
+        view_w, view_h = self.view_size(size)
+        self.move_center(dx, dy)
+        
+        canvas = self.usable_canvas(size)
+        if canvas is None or not canvas.covers(*self.center, view_w, view_h):
+            self.refresh_map() # fell off the canvas (or there isn't one yet)
+            return
+        if self.map_future is not None:
+            get_render_pool().drop(self.map_key) # the old centre, poll() would swap it back in over the pan
+        self.map_key = self.frame_key()
+        self.map_future = None
+        self.map_error = None
+        self.map_data = canvas.window(*self.center, view_w, view_h)
+        self.draw_ui()
+        self.prefetch()
+        
+    def usable_canvas(self, size):
+        # swap in a canvas that finished in the background
+        if self.overlay is not None:
+            return None # canvases are plain map, overlay frames are whole renders
+        for canvas in (self.next_canvas, self.canvas):
+            if canvas is not None and canvas.zoom == self.zoom and canvas.size == size:
+                view_w, view_h = self.view_size(size)
+                if canvas.covers(*self.center, view_w, view_h):
+                    if canvas is self.next_canvas:
+                        self.canvas, self.next_canvas = canvas, None
+                    return canvas
+        return None
+        
+    def canvas_job(self, key):
+        _, lat, lon, zoom, size, _ = key
+        view_w, view_h = self.view_size(size)
+        fast, native = self.fast, self.native
+        render = tiled_cells if self.tiled else render_cells
+        cell = get_cell_size()
+        row_px = TILE_PX / tile_lines(cell) if self.tiled else row_height(cell)
+        def job(checkpoint):
+            rows = render(lat, lon, zoom, view_w * CANVAS_SCALE, view_h * CANVAS_SCALE, fast, native, cancelled = checkpoint)
+            return Canvas(lat, lon, zoom, size, rows, row_px)
+        return job
+        
+    def canvas_done(self, future):
+        if not future.cancelled() and future.exception() is None:
+            self.next_canvas = future.result()
             
+    def render_job(self, key):
+        lat, lon, zoom, size, _ = key
+        fast, native, progressive = self.fast, self.native, self.progressive
+        kind, config = self.overlay, self.config
+        composed = self.reusable_composed(key)
+        def on_composed(image):
+            composed_cache.put(key[:3], image)
+        def on_image(image):
+            image_cache.put(key[:4] + (kind,), image) # the overlay's painted on by now
+            # the map is composed, show a rough version while the glyph pass runs
+            if progressive and not native and key == self.map_key:
+                self.preview = (key, quick_frame(image, self.view_size(size)[0]))
+                self.changed.set()
+        def tiled_job(checkpoint):
+            # no composed image on this path, zoom_preview stitches the rough version from the next zoom out instead
+            with trace.span("frame", "render", key = str(key), optimizer = optimizer_name(fast, native)):
+                rows = tiled_cells(lat, lon, zoom, *self.view_size(size), fast, native, cancelled = checkpoint)
+                with trace.span("ansi", "render"):
+                    frame = grid_to_ansi(rows)
+            frame_cache.put(key, frame)
+            return frame
+        if self.tiled and self.overlay is None:
+            return tiled_job
+        force = kind is not None and self.overlay_force
+        if force:
+            self.overlay_force = False # only the first render after [r] asks again, the rest find its grid
+        painted = []
+        def overlay(image, source):
+            # the grid is usually cached, otherwise one request for the whole view
+            grid = overlay_grid(kind, lat, lon, zoom, source, config, force = force)
+            if grid is None:
+                return image
+            painted.append(grid)
+            return paint_overlay(image, grid, lat, lon, zoom, source)
+        def job(checkpoint):
+            with trace.span("frame", "render", key = str(key), optimizer = key[4]):
+                frame = render_map(lat, lon, zoom, fast = fast, size = size, cancelled = checkpoint, native = native, on_image = on_image,
+                                   composed = composed, on_composed = on_composed, overlay = overlay if kind else None)
+            if kind is None or painted: # no weather this time, try again next time
+                frame_cache.put(key, frame)
+            if painted:
+                overlay_fetched[key] = painted[0].fetched
+            return frame
+        return job
+
+    def cached_frame(self, key, peek = False):
+        # frame_cache, except overlay frames whose weather has gone stale
+        frame = frame_cache.peek(key) if peek else frame_cache.get(key)
+        fetched = overlay_fetched.get(key)
+        if frame is not None and fetched is not None and monotonic() - fetched >= grid_ttl(self.config):
+            return None
+        return frame
+
+    def forget_overlay(self):
+        # [r] on an overlay: new grids, and no frames painted with the old ones
+        grid_cache.clear()
+        frame_cache.discard_where(lambda key: "+" in key[4])
+        overlay_fetched.clear()
+        if self.map_future is not None:
+            get_render_pool().drop(self.map_key) # still painting with the old grid
+            self.map_future = None
+        self.overlay_force = True
+    
+    def reusable_composed(self, key):
+        # an earlier compose of the same place and zoom that this frame can be cropped out of
+        lat, lon, zoom, size, _ = key
+        image = composed_cache.peek((lat, lon, zoom))
+        _, _, source, _ = map_geometry(size, get_cell_size())
+        if image is not None and image.width >= source[0] and image.height >= source[1]:
+            return image
+        return None
+        
     def refresh_map(self):
-        self.show_loading()
-        self.map_data = render_map(self.lat, self.lon, self.zoom)
-        self.draw_ui()
\ No newline at end of file
+        pool = get_render_pool()
+        key = self.frame_key()
+        if self.map_future is not None and self.map_key != key:
+            old = self.map_key
+            if old[:2] + old[3:] == key[:2] + key[3:] and abs(old[2] - key[2]) == 1:
+                pool.demote(old) # one zoom step away, still worth finishing as a guess
+            else:
+                pool.drop(old) # superseded, e.g. a burst of zoom keys went right past it
+        self.map_key = key
+        self.map_future = None
+        self.map_error = None
+        
+        frame = self.cached_frame(key)
+        if frame is not None:
+            self.map_data = frame
+            self.draw_ui()
+            self.prefetch()
+            return
+        
+        # picks up a speculative render of this frame if one is already running, poll() swaps it in
+        future = pool.submit(key, self.render_job(key), PRIORITY_VISIBLE)
+        self.map_future = future
+        self.map_data = self.zoom_preview(key) if self.progressive else None
+        future.add_done_callback(lambda _: self.changed.set())
+        self.draw_ui()
+        
+    def zoom_preview(self, key):
+        # the zoom level we came from, blown up, is close enough to look at while this one renders
+        lat, lon, zoom, size, _ = key
+        if self.tiled and self.overlay is None:
+            rows = tiled_preview(lat, lon, zoom, *self.view_size(size), self.fast, self.native)
+            return grid_to_ansi(rows) if rows is not None else None
+        image = image_cache.peek((lat, lon, zoom - 1, size, self.overlay))
+        if image is None:
+            return None
+        return quick_frame(zoom_in_image(image), self.view_size(size)[0])
+        
+    def check_resize(self):
+        size = tuple(get_terminal_size())
+        if size != self.size:
+            # still moving, redraw the cheap parts now and leave the map until it settles
+            self.size = size
+            self.resize_at = monotonic()
+            self.draw_ui()
+        elif self.resize_at is not None and monotonic() - self.resize_at >= RESIZE_DEBOUNCE:
+            self.resize_at = None
+            cell = get_cell_size()
+            if reset_cell_size() != cell:
+                # the font changed size, everything drawn so far has the wrong shape
+                frame_cache.clear()
+                image_cache.clear()
+                composed_cache.clear()
+                self.canvas = self.next_canvas = None
+                pool = get_render_pool()
+                pool.cancel_speculative()
+                if self.map_future is not None:
+                    pool.drop(self.map_key)
+                    self.map_future = None
+                self.refresh_map()
+            elif self.map_key != self.frame_key(): # a keypress may have got there first
+                self.refresh_map()
+        
+    def poll(self):
+        # redraw with whatever finished in the background since the last check
+        self.check_resize()
+        if not self.changed.is_set():
+            return
+        self.changed.clear()
+        future = self.map_future
+        preview, self.preview = self.preview, None
+        if preview is not None and preview[0] == self.map_key and future is not None and not future.done():
+            self.map_data = preview[1]
+        if future is not None and future.done():
+            self.map_future = None
+            try:
+                self.map_data = future.result()
+            except Exception as e: # a broken tile or pack costs this frame, not the whole app
+                self.map_data = None
+                self.map_error = type(e).__name__
+            else:
+                self.prefetch()
+        self.draw_ui()
+        
+    def prefetch(self):
+        # guess the next zoom press while the user is looking at this one
+        pool = get_render_pool()
+        keys = [self.frame_key(z) for z in (self.zoom + 1, self.zoom - 1) if 1 <= z <= 18]
+        
+        # and the area around it, re-centred once the view gets close to the canvas edge
+        size = tuple(get_terminal_size())
+        view_w, view_h = self.view_size(size)
+        canvas = self.usable_canvas(size)
+        canvas_key = None
+        if self.overlay is None and (canvas is None or not canvas.covers(*self.center, view_w, view_h, margin = CANVAS_MARGIN)):
+            canvas_key = ("canvas",) + self.frame_key()
+            
+        pool.cancel_speculative(keep = keys + [canvas_key])
+        if canvas_key is not None:
+            pool.submit(canvas_key, self.canvas_job(canvas_key), PRIORITY_SPECULATIVE).add_done_callback(self.canvas_done)
+        for key in keys:
+            if self.cached_frame(key, peek = True) is None:
+                pool.submit(key, self.render_job(key), PRIORITY_SPECULATIVE)
\ No newline at end of file
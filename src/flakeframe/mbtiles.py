@@ -0,0 +1,250 @@
+# Offline map tiles: MBTiles files (sqlite, one blob per tile) as a tile provider, and the pack command that
+# downloads a region into one
+
+import math
+import os
+import sqlite3
+import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import staticmaps # py-staticmaps
+from flakeframe.tilecache import get_tile_downloader, MAX_IN_FLIGHT
+from flakeframe.trace import span
+
+MBTILES_MMAP = 256 * 1024 * 1024 # bytes of the file sqlite may map instead of read()
+PACK_BATCH = 256                 # tiles per commit, a killed pack run loses at most this many
+PACK_MAX_TILES = 100_000         # sanity limit, --max-tiles to go past it
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS metadata (name TEXT, value TEXT);
+CREATE TABLE IF NOT EXISTS tiles (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_data BLOB);
+CREATE UNIQUE INDEX IF NOT EXISTS tile_index ON tiles (zoom_level, tile_column, tile_row);
+CREATE UNIQUE INDEX IF NOT EXISTS metadata_name ON metadata (name);
+"""
+
+def tms_row(zoom, y) -> int:
+    # mbtiles rows count from the bottom (TMS), staticmaps' y from the top
+    return (1 << zoom) - 1 - y
+
+class MBTiles:
+    # read only, a connection per thread so renders on different workers don't queue on each other
+    def __init__(self, path):
+        if not os.path.exists(path):
+            raise FileNotFoundError(path)
+        self.path = path
+        self.local = threading.local()
+
+    def db(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(f"file:{self.path}?mode=ro", uri = True)
+            conn.execute(f"PRAGMA mmap_size = {MBTILES_MMAP}")
+            self.local.conn = conn
+        return conn
+
+    def get(self, zoom, x, y):
+        row = self.db().execute(
+            "SELECT tile_data FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?",
+            (zoom, x, tms_row(zoom, y))).fetchone()
+        return row[0] if row else None
+
+    def has(self, zoom, x, y) -> bool:
+        return self.db().execute(
+            "SELECT 1 FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?",
+            (zoom, x, tms_row(zoom, y))).fetchone() is not None
+
+    def metadata(self) -> dict:
+        return dict(self.db().execute("SELECT name, value FROM metadata").fetchall())
+
+class MBTilesProvider(staticmaps.TileProvider):
+    # tiles out of a pack file, anything it doesn't have comes from fallback (or stays blank without one)
+    def __init__(self, path, fallback = None):
+        self.pack = MBTiles(path)
+        self.fallback = fallback
+        meta = self.pack.metadata()
+        attribution = meta.get("attribution") or (fallback.attribution() if fallback else None)
+        max_zoom = int(meta.get("maxzoom", 20)) if fallback is None else fallback.max_zoom()
+        super().__init__(f"mbtiles-{os.path.basename(path)}", "", attribution = attribution, max_zoom = max_zoom)
+
+    def read(self, zoom, x, y):
+        with span("pack read", "tiles"):
+            return self.pack.get(zoom, x, y)
+
+    def has(self, zoom, x, y) -> bool:
+        return self.pack.has(zoom, x, y)
+
+_pack_provider = None
+_pack_settings = {"path": None, "fallback": True}
+_pack_lock = threading.Lock()
+
+def configure_tile_pack(path = None, fallback = True):
+    global _pack_provider
+    with _pack_lock:
+        _pack_settings["path"] = os.path.expanduser(path) if path else None
+        _pack_settings["fallback"] = fallback
+        _pack_provider = None
+
+def tile_pack_settings():
+    # to hand to worker processes
+    return dict(_pack_settings)
+
+def get_pack_provider(fallback):
+    # the configured pack wrapped around fallback, or None when there's no pack
+    global _pack_provider
+    with _pack_lock:
+        path = _pack_settings["path"]
+        if path is None or not os.path.exists(path):
+            return None
+        if _pack_provider is None:
+            _pack_provider = MBTilesProvider(path, fallback if _pack_settings["fallback"] else None)
+        return _pack_provider
+
+def region_tiles(bbox, zoom):
+    # (min lon, min lat, max lon, max lat) -> every (x, y) tile touching it
+    min_lon, min_lat, max_lon, max_lat = bbox
+    n = 1 << zoom
+    def tile_x(lon):
+        return min(n - 1, max(0, int((lon + 180) / 360 * n)))
+    def tile_y(lat):
+        lat = max(min(lat, 85.0511), -85.0511)
+        return min(n - 1, max(0, int((1 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2 * n)))
+    for x in range(tile_x(min_lon), tile_x(max_lon) + 1):
+        for y in range(tile_y(max_lat), tile_y(min_lat) + 1):
+            yield x, y
+
+def parse_bbox(text):
+    parts = [float(v) for v in text.split(",")]
+    if len(parts) != 4 or parts[0] >= parts[2] or parts[1] >= parts[3]:
+        raise ValueError("bbox is min_lon,min_lat,max_lon,max_lat")
+    return tuple(parts)
+
+def parse_zooms(text):
+    # "12" or "10-15"
+    low, _, high = text.partition("-")
+    low, high = int(low), int(high or low)
+    if not 0 <= low <= high <= 20:
+        raise ValueError("zooms go from 0 to 20, e.g. 10-15")
+    return range(low, high + 1)
+
+def image_format(data) -> str:
+    return "jpg" if data[:2] == b"\xff\xd8" else "webp" if data[8:12] == b"WEBP" else "png"
+
+def fetch_for_pack(downloader, provider, zoom, x, y):
+    # whatever the tile cache has already, otherwise straight from the server without filling the cache
+    data, _, _ = downloader.store.get(provider.name(), zoom, x, y)
+    if data is None:
+        data, _ = downloader.download(provider, zoom, x, y)
+    return data
+
+def pack_region(path, provider, bbox, zooms, name = None, workers = MAX_IN_FLIGHT, progress = None):
+    # download every tile of bbox at each zoom into path, skipping what's already there so a stopped run
+    # picks up where it left off -> (fetched, skipped, failed)
+    db = sqlite3.connect(path)
+    db.executescript(SCHEMA)
+    meta = {
+        "name": name or os.path.splitext(os.path.basename(path))[0],
+        "type": "baselayer",
+        "version": "1",
+        "description": f"{provider.name()} tiles packed by flakeframe",
+        "attribution": provider.attribution() or "",
+        "bounds": ",".join(f"{v:.6f}" for v in bbox),
+        "minzoom": str(zooms[0]),
+        "maxzoom": str(zooms[-1]),
+    }
+    old = dict(db.execute("SELECT name, value FROM metadata").fetchall())
+    if "minzoom" in old: # a second run over more zooms or area widens the pack instead of forgetting the first
+        meta["minzoom"] = str(min(int(old["minzoom"]), zooms[0]))
+        meta["maxzoom"] = str(max(int(old["maxzoom"]), zooms[-1]))
+        prev = [float(v) for v in old["bounds"].split(",")]
+        meta["bounds"] = ",".join(f"{v:.6f}" for v in (*map(min, prev[:2], bbox[:2]), *map(max, prev[2:], bbox[2:])))
+    db.executemany("INSERT OR REPLACE INTO metadata VALUES (?, ?)", meta.items())
+    db.commit()
+
+    downloader = get_tile_downloader()
+    pool = ThreadPoolExecutor(workers, thread_name_prefix = "pack")
+    fetched = skipped = failed = 0
+    batch = []
+
+    def flush():
+        nonlocal batch
+        if batch:
+            db.executemany("INSERT OR REPLACE INTO tiles VALUES (?, ?, ?, ?)", batch)
+            if "format" not in old:
+                db.execute("INSERT OR REPLACE INTO metadata VALUES ('format', ?)", (image_format(batch[0][3]),))
+                old["format"] = True
+            db.commit()
+            batch = []
+
+    def todo():
+        nonlocal skipped
+        for zoom in zooms:
+            have = set(db.execute("SELECT tile_column, tile_row FROM tiles WHERE zoom_level = ?", (zoom,)).fetchall())
+            for x, y in region_tiles(bbox, zoom):
+                if (x, tms_row(zoom, y)) in have:
+                    skipped += 1
+                else:
+                    yield zoom, x, y
+
+    # a bounded window of downloads in flight, the tile list for a big region doesn't fit in futures
+    pending = {}
+    tiles = todo()
+    try:
+        while True:
+            while len(pending) < workers * 4:
+                tile = next(tiles, None)
+                if tile is None:
+                    break
+                pending[pool.submit(fetch_for_pack, downloader, provider, *tile)] = tile
+            if not pending:
+                break
+            done, _ = wait(pending, return_when = FIRST_COMPLETED)
+            for future in done:
+                zoom, x, y = pending.pop(future)
+                try:
+                    data = future.result()
+                except RuntimeError:
+                    data = None
+                if data is None:
+                    failed += 1
+                    continue
+                batch.append((zoom, x, tms_row(zoom, y), data))
+                fetched += 1
+            if len(batch) >= PACK_BATCH:
+                flush()
+            if progress:
+                progress(fetched, skipped, failed)
+    finally:
+        pool.shutdown(wait = True, cancel_futures = True)
+        flush() # keep everything that made it, the next run skips it
+        db.close()
+    return fetched, skipped, failed
+
+def pack_command(args, config = None):
+    from flakeframe.map import base_provider
+    try:
+        bbox = parse_bbox(args.bbox)
+        zooms = parse_zooms(args.zooms)
+    except ValueError as e:
+        print(e, file = sys.stderr)
+        return 2
+    total = sum(1 for zoom in zooms for _ in region_tiles(bbox, zoom))
+    if total > args.max_tiles:
+        print(f"{total:,} tiles is a lot to ask of a free tile server, narrow it down or pass --max-tiles", file = sys.stderr)
+        return 2
+
+    start = time.perf_counter()
+    def progress(fetched, skipped, failed):
+        done = fetched + skipped + failed
+        rate = fetched / max(time.perf_counter() - start, 1e-6)
+        print(f"\r{done:,}/{total:,} tiles ({skipped:,} already packed, {failed:,} failed) {rate:.0f}/s",
+              end = "", file = sys.stderr, flush = True)
+    try:
+        fetched, skipped, failed = pack_region(args.output, base_provider(), bbox, zooms, args.name, args.workers, progress)
+    except KeyboardInterrupt:
+        print("\nstopped, run the same command again to carry on", file = sys.stderr)
+        return 130
+    print(f"\n{fetched:,} fetched, {skipped:,} already there, {failed:,} failed -> {args.output}", file = sys.stderr)
+    if failed:
+        print("run it again to retry the failed ones", file = sys.stderr)
+    return 1 if failed else 0
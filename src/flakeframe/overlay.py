@@ -0,0 +1,140 @@
+# Weather painted over the map: one batched open-meteo request for a coarse grid of points around the view,
+# interpolated to every pixel with numpy and blended onto the composed image before it turns into glyphs
+
+import math
+import numpy as np
+from time import monotonic
+from PIL import Image
+from flakeframe.cache import LRUCache
+from flakeframe.map import latlon_to_world, world_to_latlon
+from flakeframe.trace import span
+from flakeframe.weather import WEATHER_TTL, fetch_weather_batch
+
+OVERLAYS = ("precip", "temp")
+OVERLAY_GRID = 8        # points per side, 64 locations fits in one request
+OVERLAY_MARGIN = 0.5    # the grid reaches this many view sizes past each edge, so pans and zooming in stay inside it
+OVERLAY_MIN_STEP = 0.05 # degrees, about the forecast model's resolution, a finer grid would just repeat itself
+PRECIP_HOURS = 3        # precip shows what's coming, right now is zero nearly everywhere nearly always
+
+# (value, r, g, b, alpha) stops, values in °C and mm
+RAMPS = {
+    "temp": np.array([
+        (-20, 150, 80, 220, 0.45), (-5, 60, 130, 255, 0.45), (5, 60, 210, 210, 0.45), (15, 120, 220, 80, 0.45),
+        (25, 255, 210, 50, 0.45), (35, 255, 90, 30, 0.5), (45, 170, 0, 50, 0.55),
+    ], dtype = np.float32),
+    "precip": np.array([
+        (0, 90, 170, 255, 0), (0.2, 90, 170, 255, 0.3), (2, 40, 100, 255, 0.5), (8, 130, 50, 230, 0.6), (20, 220, 0, 170, 0.7),
+    ], dtype = np.float32),
+}
+RAMP_STEPS = 1024 # the ramps get baked into lookup tables this long, a lookup is a lot cheaper than 4 np.interp per pixel
+LABELS = {"temp": "temperature now", "precip": f"precip next {PRECIP_HOURS}h"}
+
+def bake(ramp):
+    # -> (lowest value, steps per unit, (RAMP_STEPS, 4) table of colour * alpha and 1 - alpha)
+    low, high = float(ramp[0, 0]), float(ramp[-1, 0])
+    values = np.linspace(low, high, RAMP_STEPS)
+    alpha = np.interp(values, ramp[:, 0], ramp[:, 4])
+    table = np.stack([np.interp(values, ramp[:, 0], ramp[:, c]) * alpha for c in (1, 2, 3)] + [1 - alpha], axis = 1)
+    return low, (RAMP_STEPS - 1) / (high - low), table.astype(np.float32)
+
+LUTS = {kind: bake(ramp) for kind, ramp in RAMPS.items()}
+
+# sampled grids, zooming in or panning a little finds one here instead of asking again
+# this is the only place samples are kept, they stay out of the weather cache on disk
+grid_cache = LRUCache(8)
+
+class OverlayGrid:
+    def __init__(self, kind, lats, lons, values):
+        self.kind = kind
+        self.lats = lats     # ascending
+        self.lons = lons     # ascending
+        self.values = values # (len(lats), len(lons)), °C or mm
+        self.step = max(lats[1] - lats[0], lons[1] - lons[0])
+        self.fetched = monotonic()
+
+    def covers(self, south, west, north, east) -> bool:
+        return self.lats[0] <= south and north <= self.lats[-1] and self.lons[0] <= west and east <= self.lons[-1]
+
+def grid_ttl(config) -> float:
+    # seconds a grid gets reused, same as the weather it was sampled from
+    return config["DEFAULT"].getfloat("weather_ttl_minutes", WEATHER_TTL / 60) * 60
+
+def view_bounds(lat, lon, zoom, source):
+    # (south, west, north, east) of a view of source map pixels centred on lat/lon
+    x, y = latlon_to_world(lat, lon, zoom)
+    north, west = world_to_latlon(x - source[0] / 2, y - source[1] / 2, zoom)
+    south, east = world_to_latlon(x + source[0] / 2, y + source[1] / 2, zoom)
+    if east < west: # across the dateline, the overlay just covers the bigger side
+        west, east = (west, 180.0) if 180 - west > east + 180 else (-180.0, east)
+    return south, west, north, east
+
+def sample_value(kind, data):
+    if data is None:
+        return math.nan
+    if kind == "temp":
+        t = data.current.temperature
+        return (t - 32) / 1.8 if "F" in data.units_temp else t
+    mm = sum(h.precipitation for h in data.hourly.next_hours(PRECIP_HOURS))
+    return mm * 25.4 if data.units_precip == "inch" else mm
+
+def axis(low, high):
+    # fewer points when the view is small, but never spaced wider than OVERLAY_MIN_STEP once it's that small
+    count = max(2, min(OVERLAY_GRID, math.ceil((high - low) / OVERLAY_MIN_STEP) + 1))
+    return np.linspace(low, high, count)
+
+def overlay_grid(kind, lat, lon, zoom, source, config, force = False):
+    # -> an OverlayGrid covering the view, cached or fetched in one request, None when there's no weather to be had
+    south, west, north, east = bounds = view_bounds(lat, lon, zoom, source)
+    extent = max(north - south, east - west)
+    oldest = monotonic() - grid_ttl(config)
+    for grid in grid_cache.values():
+        if grid.kind == kind and grid.fetched > oldest and grid.covers(*bounds) and grid.step <= max(extent, OVERLAY_MIN_STEP):
+            return grid
+
+    pad_lat, pad_lon = (north - south) * OVERLAY_MARGIN, (east - west) * OVERLAY_MARGIN
+    lats = axis(max(-85.0, south - pad_lat), min(85.0, north + pad_lat))
+    lons = axis(max(-180.0, west - pad_lon), min(180.0, east + pad_lon))
+    with span("overlay grid", "weather", kind = kind, points = len(lats) * len(lons)):
+        results = fetch_weather_batch([(a, o) for a in lats for o in lons], config, force = force, keep = False)
+    values = np.array([sample_value(kind, data) for data in results], dtype = np.float32).reshape(len(lats), len(lons))
+    if np.isnan(values).all():
+        return None
+    values[np.isnan(values)] = np.nanmean(values) # a point or two missing shouldn't punch holes
+    grid = OverlayGrid(kind, lats, lons, values)
+    grid_cache.put((kind, lats[0], lons[0], lats[-1], lons[-1]), grid)
+    return grid
+
+def sample(grid, lats, lons):
+    # bilinear over the grid at every (lat, lon) pair of the two axes, separable so it's two passes of fancy indexing
+    fx = np.interp(lons, grid.lons, np.arange(len(grid.lons), dtype = np.float32))
+    fy = np.interp(lats, grid.lats, np.arange(len(grid.lats), dtype = np.float32))
+    x0 = np.minimum(fx.astype(np.intp), len(grid.lons) - 2)
+    y0 = np.minimum(fy.astype(np.intp), len(grid.lats) - 2)
+    tx = (fx - x0).astype(np.float32)
+    ty = (fy - y0).astype(np.float32)[:, None]
+    across = grid.values[:, x0] * (1 - tx) + grid.values[:, x0 + 1] * tx # (grid rows, width)
+    return across[y0] * (1 - ty) + across[y0 + 1] * ty                    # (height, width)
+
+def paint_overlay(image, grid, lat, lon, zoom, source):
+    # blend the grid's colour ramp onto image, which shows source map pixels around lat/lon at any size
+    with span("overlay", "render", kind = grid.kind):
+        w, h = image.size
+        world = 256 * 2 ** zoom
+        cx, cy = latlon_to_world(lat, lon, zoom)
+        xs = cx - source[0] / 2 + (np.arange(w) + 0.5) * (source[0] / w)
+        ys = cy - source[1] / 2 + (np.arange(h) + 0.5) * (source[1] / h)
+        lons = (xs / world * 360) % 360 - 180
+        lats = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * np.clip(ys, 0, world) / world))))
+        field = sample(grid, lats, lons)
+
+        low, scale, table = LUTS[grid.kind]
+        baked = table[np.clip((field - low) * scale, 0, RAMP_STEPS - 1).astype(np.intp)]
+        pixels = np.asarray(image.convert("RGB"), dtype = np.float32)
+        return Image.fromarray((pixels * baked[:, :, 3:] + baked[:, :, :3]).astype(np.uint8))
+
+def legend(kind) -> str:
+    # one line of coloured swatches with the values they stand for
+    ramp = RAMPS[kind] if kind == "temp" else RAMPS[kind][1:] # no swatch for the see-through end
+    unit = "°C" if kind == "temp" else "mm" # sample_value converts to these whatever the configured units
+    parts = [f"\x1b[48;2;{int(r)};{int(g)};{int(b)}m\x1b[38;2;0;0;0m{v:g}{unit}" for v, r, g, b, _ in ramp]
+    return f"\x1b[0;38;5;86m{LABELS[kind]} " + "\x1b[0m ".join(parts) + "\x1b[0m"
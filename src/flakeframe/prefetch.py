@@ -0,0 +1,144 @@
+# Background render pool, the frame on screen always jumps the queue
+
+import queue
+import threading
+from concurrent.futures import Future
+from flakeframe.map import RenderCancelled
+
+PRIORITY_VISIBLE = 0
+PRIORITY_SPECULATIVE = 1
+
+class Job:
+    def __init__(self, pool, key, fn, priority):
+        self.pool = pool
+        self.key = key
+        self.fn = fn
+        self.priority = priority
+        self.future = Future()
+        self.cancelled = threading.Event()
+        self.started = False
+        self.runner = None # which worker picked it up
+
+    def checkpoint(self) -> bool:
+        # called by the job between stages, speculative work waits here while a visible frame renders
+        while self.priority != PRIORITY_VISIBLE and not self.cancelled.is_set():
+            if self.pool.visible_idle.wait(0.05):
+                break
+        return self.cancelled.is_set()
+
+class RenderPool:
+    # one worker only ever takes visible jobs so a paused guess can never block the frame we need
+    def __init__(self, workers = 2):
+        self.queues = {PRIORITY_VISIBLE: queue.Queue(), PRIORITY_SPECULATIVE: queue.Queue()}
+        self.lock = threading.Lock()
+        self.pending = {} # key -> Job, queued or running
+        self.visible = 0
+        self.visible_idle = threading.Event()
+        self.visible_idle.set()
+        threading.Thread(target = self.worker, args = (PRIORITY_VISIBLE,), daemon = True).start()
+        for _ in range(workers):
+            threading.Thread(target = self.worker, args = (PRIORITY_SPECULATIVE,), daemon = True).start()
+
+    def submit(self, key, fn, priority = PRIORITY_SPECULATIVE) -> Future:
+        # fn(checkpoint) -> result, checkpoint() returns True once the job should give up
+        with self.lock:
+            job = self.pending.get(key)
+            if job is not None and not job.cancelled.is_set():
+                if priority < job.priority:
+                    self.set_priority(job, priority)
+                    if not job.started:
+                        self.queues[priority].put(job) # whichever worker gets it first wins
+                return job.future
+
+            job = Job(self, key, fn, priority)
+            self.pending[key] = job
+            if priority == PRIORITY_VISIBLE:
+                self.add_visible(1)
+            self.queues[priority].put(job)
+            return job.future
+
+    def set_priority(self, job, priority):
+        if job.priority == PRIORITY_VISIBLE:
+            self.add_visible(-1)
+        if priority == PRIORITY_VISIBLE:
+            self.add_visible(1)
+        job.priority = priority
+
+    def add_visible(self, n):
+        self.visible += n
+        if self.visible > 0:
+            self.visible_idle.clear()
+        else:
+            self.visible_idle.set()
+
+    def demote(self, key):
+        # nobody is waiting on this visible job anymore, it goes back to being a guess
+        with self.lock:
+            job = self.pending.get(key)
+            if job is None or job.priority != PRIORITY_VISIBLE:
+                return
+            if job.runner == PRIORITY_VISIBLE:
+                self.cancel(job) # a paused guess on the visible worker would block the next frame
+            else:
+                self.set_priority(job, PRIORITY_SPECULATIVE)
+
+    def drop(self, key):
+        # a newer target made this one pointless, stop it wherever it is
+        with self.lock:
+            job = self.pending.get(key)
+            if job is not None:
+                self.cancel(job)
+
+    def cancel(self, job):
+        # lock held by caller
+        job.cancelled.set()
+        job.future.cancel() # only works if it hasn't started, otherwise the checkpoint stops it
+        self.set_priority(job, PRIORITY_SPECULATIVE)
+        if self.pending.get(job.key) is job:
+            del self.pending[job.key]
+
+    def cancel_speculative(self, keep = ()):
+        # the view moved on, drop guesses that are no longer useful
+        with self.lock:
+            for key, job in list(self.pending.items()):
+                if job.priority != PRIORITY_VISIBLE and key not in keep:
+                    self.cancel(job)
+
+    def worker(self, priority):
+        while True:
+            job = self.queues[priority].get()
+            with self.lock:
+                if job.started or job.cancelled.is_set():
+                    continue
+                if priority == PRIORITY_VISIBLE and job.priority != PRIORITY_VISIBLE:
+                    self.queues[job.priority].put(job) # demoted while it was queued
+                    continue
+                job.started = True
+                job.runner = priority
+            if not job.future.set_running_or_notify_cancel():
+                continue
+
+            try:
+                if job.checkpoint():
+                    raise RenderCancelled()
+                result = job.fn(job.checkpoint)
+            except BaseException as e:
+                job.future.set_exception(e)
+            else:
+                job.future.set_result(result)
+            finally:
+                with self.lock:
+                    if job.priority == PRIORITY_VISIBLE:
+                        self.add_visible(-1)
+                    if self.pending.get(job.key) is job:
+                        del self.pending[job.key]
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_render_pool() -> RenderPool:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = RenderPool()
+        return _pool
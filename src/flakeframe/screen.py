@@ -0,0 +1,271 @@
+# Screen buffer, frames are drawn into a virtual grid and only the cells that changed get sent
+
+import atexit
+import re
+import shutil
+import sys
+import threading
+import unicodedata
+from flakeframe.input import query_terminal
+from flakeframe.trace import span
+
+# a map cell from cells.py in one go (the bulk of every frame), full CSI, CSI cut short by another ESC
+# (terminals drop it), any other escape, line breaks, plain text
+TOKENS = re.compile(
+    r"\x1b\[38;2;(\d+;\d+;\d+)m\x1b\[48;2;(\d+;\d+;\d+)m([^\x1b\n\r])"
+    r"|\x1b\[([0-9;?]*)([@-~])|\x1b\[[0-9;?]*(?=\x1b)|\x1b[^\[]?|\n|\r|[^\x1b\n\r]+"
+)
+
+RESET_STYLE = "0"
+BLANK = (" ", RESET_STYLE)
+RUN_GAP = 8 # unchanged cells cheaper to resend than a cursor move
+SYNC_BEGIN = "\x1b[?2026h" # synchronized update, the terminal shows the frame all at once
+SYNC_END = "\x1b[?2026l"
+
+_widths = {}
+
+def char_width(ch) -> int:
+    w = _widths.get(ch)
+    if w is None:
+        if unicodedata.combining(ch) or unicodedata.category(ch) in ("Cf", "Cc"):
+            w = 0
+        elif unicodedata.east_asian_width(ch) in ("W", "F"):
+            w = 2
+        else:
+            w = 1
+        _widths[ch] = w
+    return w
+
+_styles = {RESET_STYLE: (None, None, ())} # style string -> (fg, bg, attrs)
+_transitions = {}
+
+def apply_sgr(style, params) -> str:
+    # current style string + SGR params -> new style string, "0;fg;bg;attrs" so it can be sent as is
+    new = _transitions.get((style, params))
+    if new is not None:
+        return new
+
+    fg, bg, attrs = _styles[style]
+    attrs = set(attrs)
+    parts = [int(p) if p.isdigit() else 0 for p in params.split(";")] if params else [0]
+    i = 0
+    while i < len(parts):
+        p = parts[i]
+        if p == 0:
+            fg, bg, attrs = None, None, set()
+        elif p in (38, 48):
+            if i + 1 < len(parts) and parts[i + 1] == 5:
+                colour, i = ";".join(map(str, parts[i:i + 3])), i + 2
+            elif i + 1 < len(parts) and parts[i + 1] == 2:
+                colour, i = ";".join(map(str, parts[i:i + 5])), i + 4
+            else:
+                colour = None
+            if p == 38:
+                fg = colour
+            else:
+                bg = colour
+        elif 30 <= p <= 37 or 90 <= p <= 97:
+            fg = str(p)
+        elif 40 <= p <= 47 or 100 <= p <= 107:
+            bg = str(p)
+        elif p == 39:
+            fg = None
+        elif p == 49:
+            bg = None
+        elif 1 <= p <= 9:
+            attrs.add(p)
+        elif p == 22:
+            attrs -= {1, 2}
+        elif 23 <= p <= 29:
+            attrs.discard(p - 20)
+        i += 1
+
+    attrs = tuple(sorted(attrs))
+    new = ";".join([RESET_STYLE] + [c for c in (fg, bg) if c] + [str(a) for a in attrs])
+    _styles.setdefault(new, (fg, bg, attrs))
+    _transitions[(style, params)] = new
+    return new
+
+def parse(text, width, height):
+    # replay the cursor moves, clears and colours a frame uses -> (grid of (char, style), cursor)
+    grid = [[BLANK] * width for _ in range(height)]
+    x = y = 0
+    style = RESET_STYLE
+    for m in TOKENS.finditer(text):
+        cell = m.group(3)
+        if cell is not None:
+            if _styles[style][2]:
+                style = apply_sgr(apply_sgr(style, "38;2;" + m.group(1)), "48;2;" + m.group(2))
+            else:
+                style = "0;38;2;" + m.group(1) + ";48;2;" + m.group(2)
+                if style not in _styles:
+                    _styles[style] = ("38;2;" + m.group(1), "48;2;" + m.group(2), ())
+            if y < height and x < width and _widths.get(cell) == 1:
+                grid[y][x] = (cell, style)
+                x += 1
+                continue
+            token = cell
+        else:
+            token = m.group(0)
+        if token[0] == "\x1b":
+            final = m.group(5)
+            if final == "m":
+                style = apply_sgr(style, m.group(4))
+            elif final in ("H", "f"):
+                pos = m.group(4).split(";") + [""]
+                y = max(int(pos[0]) - 1, 0) if pos[0].isdigit() else 0
+                x = max(int(pos[1]) - 1, 0) if pos[1].isdigit() else 0
+            elif final == "J" and m.group(4) == "2":
+                grid = [[BLANK] * width for _ in range(height)]
+            continue # anything else doesn't change what's on screen
+        if token == "\n":
+            x, y = 0, y + 1 # the input session leaves OPOST on, so this is a CRLF
+            continue
+        if token == "\r":
+            x = 0
+            continue
+        if y >= height:
+            continue
+        row = grid[y]
+        for ch in token:
+            w = char_width(ch)
+            if w == 0:
+                continue
+            if x + w <= width:
+                row[x] = (ch, style)
+                if w == 2:
+                    row[x + 1] = ("", style) # right half of a wide char
+            x += w
+    return grid, (min(x, width - 1), min(y, height - 1))
+
+def detect_sync() -> bool:
+    # DECRQM for mode 2026, with a DA1 behind it that every terminal answers so we don't sit out the timeout
+    match = query_terminal("\x1b[?2026$p\x1b[c", rb"(?:\x1b\[\?2026;(\d)\$y)?\x1b\[\?[\d;]*c")
+    return bool(match and match.group(1) in (b"1", b"2"))
+
+class Screen:
+    # frames are queued for a writer thread, a newer frame replaces one that hasn't gone out yet
+    def __init__(self, out = None):
+        self.out = out   # None -> whatever sys.stdout is at the time
+        self.prev = None # grid that is on the terminal right now, only the writer touches it
+        self.written = None # and its size
+        self.size = None # size of the last frame presented
+        self.parts = []
+        self.text = None # last frame as drawn, a redraw of the same thing skips the parse
+        self.sync = None # terminal does synchronized updates, asked on the first frame
+        self.sent = 0    # bytes of the last frame, for debugging
+        self.dropped = 0 # frames replaced before they were written
+        self.pending = None
+        self.busy = False
+        self.cond = threading.Condition()
+        self.thread = None
+
+    def begin(self):
+        # start a new frame, stands in for clear()
+        self.parts = []
+
+    def write(self, s):
+        self.parts.append(s)
+
+    def invalidate(self):
+        # something else drew on the terminal, next frame repaints everything
+        self.wait()
+        self.prev = None
+        self.text = None
+
+    def present(self):
+        size = tuple(shutil.get_terminal_size((80, 24)))
+        text = "".join(self.parts)
+        self.parts = []
+        if text == self.text and size == self.size:
+            return
+        if self.sync is None:
+            self.wait() # the query talks to the terminal too
+            self.sync = detect_sync()
+        with span("present", "ui"):
+            grid, cursor = parse(text, *size)
+        self.text, self.size = text, size
+
+        with self.cond:
+            if self.pending is not None:
+                self.dropped += 1 # never made it out, the writer diffs against what did
+            self.pending = (grid, cursor, size)
+            self.cond.notify_all()
+            if self.thread is None:
+                self.thread = threading.Thread(target = self.writer, daemon = True)
+                self.thread.start()
+
+    def writer(self):
+        while True:
+            with self.cond:
+                while self.pending is None:
+                    self.cond.wait()
+                (grid, cursor, size), self.pending = self.pending, None
+                self.busy = True
+            try:
+                with span("write", "ui") as s:
+                    data = self.diff(grid, cursor, size)
+                    self.prev, self.written = grid, size
+                    if self.sync:
+                        data = SYNC_BEGIN + data + SYNC_END
+                    self.sent = len(data.encode())
+                    s.set(bytes = self.sent)
+                    out = self.out or sys.stdout
+                    out.write(data) # one write per frame, this is the part that can block
+                    out.flush()
+            except (OSError, ValueError):
+                pass # terminal went away
+            finally:
+                with self.cond:
+                    self.busy = False
+                    self.cond.notify_all()
+
+    def wait(self):
+        # until everything presented so far is on the terminal, before writing to stdout directly
+        with self.cond:
+            while self.pending is not None or self.busy:
+                self.cond.wait()
+
+    def diff(self, grid, cursor, size) -> str:
+        out = []
+        prev = self.prev
+        if prev is None or self.written != size:
+            out.append("\x1b[0m\x1b[2J")
+            prev = [[BLANK] * size[0] for _ in range(size[1])]
+
+        style = None # unknown after a cursor move from somewhere else
+        for y, (row, old) in enumerate(zip(grid, prev)):
+            if row == old:
+                continue
+            for start, end in changed_runs(row, old):
+                while start > 0 and row[start][0] == "":
+                    start -= 1 # don't start halfway through a wide char
+                while end < len(row) and row[end][0] == "":
+                    end += 1
+                out.append(f"\x1b[{y + 1};{start + 1}H")
+                for ch, st in row[start:end]:
+                    if not ch:
+                        continue
+                    if st != style:
+                        out.append(f"\x1b[{st}m")
+                        style = st
+                    out.append(ch)
+
+        if style not in (None, RESET_STYLE):
+            out.append("\x1b[0m")
+        out.append(f"\x1b[{cursor[1] + 1};{cursor[0] + 1}H")
+        return "".join(out)
+
+def changed_runs(row, old):
+    # [start, end) spans of changed cells, close ones merged
+    runs = []
+    for x, (a, b) in enumerate(zip(row, old)):
+        if a != b:
+            if runs and x - runs[-1][1] <= RUN_GAP:
+                runs[-1][1] = x + 1
+            else:
+                runs.append([x, x + 1])
+    return runs
+
+screen = Screen()
+atexit.register(screen.wait)
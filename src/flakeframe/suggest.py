@@ -0,0 +1,128 @@
+# Live search suggestions, looked up once typing pauses and thrown away if the text moved on
+# only local sources: nominatim's usage policy doesn't allow autocomplete against it
+
+import re
+import threading
+import time
+from dataclasses import dataclass
+from typing import List
+from flakeframe.cache import LRUCache
+from flakeframe.gazetteer import get_gazetteer, normalize
+from flakeframe.geocode import get_geocode_cache
+
+SUGGEST_DELAY = 0.12 # seconds without a key before looking anything up
+SUGGEST_MIN = 2      # characters before there's anything to suggest
+SUGGEST_LIMIT = 5
+
+@dataclass
+class Suggestion:
+    label: str
+    lat: float
+    lon: float
+
+def words(text):
+    return re.findall(r"\w+", normalize(text))
+
+def matches(label, key) -> bool:
+    # every word typed starts some word of the label, same rule as the gazetteer's partial search
+    label_words = words(label)
+    return all(any(w.startswith(t) for w in label_words) for t in words(key))
+
+def recent_searches(key, limit) -> List[Suggestion]:
+    # things that were looked up on nominatim before
+    found = []
+    for query, entry in reversed(get_geocode_cache().items()): # most recently used first
+        if entry[0] is not None and matches(query, key):
+            found.append(Suggestion(query, entry[0], entry[1]))
+            if len(found) >= limit:
+                break
+    return found
+
+def lookup(text, limit = SUGGEST_LIMIT) -> List[Suggestion]:
+    found = recent_searches(normalize(text), limit)
+    gazetteer = get_gazetteer()
+    if gazetteer is not None and len(found) < limit:
+        seen = {(round(s.lat, 2), round(s.lon, 2)) for s in found}
+        for place in gazetteer.search(text, limit = limit):
+            if (round(place.lat, 2), round(place.lon, 2)) not in seen:
+                found.append(Suggestion(place.label(), place.lat, place.lon))
+    return found[:limit]
+
+class Suggester:
+    # one worker, one slot: a newer keystroke replaces the queued text and pushes the lookup back
+    def __init__(self, delay = SUGGEST_DELAY):
+        self.delay = delay
+        self.cache = LRUCache(256) # normalized text -> suggestions
+        self.cond = threading.Condition()
+        self.pending = None        # (text, generation) waiting for typing to pause
+        self.due = 0.0
+        self.generation = 0
+        self.text = ""
+        self.results = []
+        self.changed = threading.Event() # new results to draw
+        threading.Thread(target = self.worker, daemon = True).start()
+
+    def update(self, text):
+        # every keystroke, never blocks
+        key = normalize(text)
+        with self.cond:
+            self.generation += 1
+            self.text = text
+            self.pending = None
+            if len(key) < SUGGEST_MIN:
+                self.set_results([])
+                return
+            cached, complete = self.from_cache(key)
+            if cached is not None:
+                self.set_results(cached)
+            if complete:
+                return
+            self.pending = (text, self.generation)
+            self.due = time.monotonic() + self.delay
+            self.cond.notify()
+
+    def from_cache(self, key):
+        # -> (suggestions or None, whether they're final); a shorter prefix that had fewer than a full page of
+        # results already holds everything this one can match
+        hit = self.cache.get(key)
+        if hit is not None:
+            return hit, True
+        for end in range(len(key) - 1, SUGGEST_MIN - 1, -1):
+            prefix = self.cache.peek(key[:end])
+            if prefix is not None:
+                return [s for s in prefix if matches(s.label, key)], len(prefix) < SUGGEST_LIMIT
+        return None, False
+
+    def set_results(self, results):
+        # lock held by caller
+        if results != self.results:
+            self.results = results
+            self.changed.set()
+
+    def worker(self):
+        while True:
+            with self.cond:
+                while self.pending is None or time.monotonic() < self.due:
+                    self.cond.wait(None if self.pending is None else self.due - time.monotonic())
+                (text, generation), self.pending = self.pending, None
+            try:
+                results = lookup(text)
+            except Exception: # e.g. the gazetteer locked mid-import, nothing this time but the thread lives on
+                with self.cond:
+                    if generation == self.generation:
+                        self.set_results([])
+                continue # not cached, the same text gets a proper try next time
+            with self.cond:
+                self.cache.put(normalize(text), results)
+                if generation == self.generation: # typed on while we were looking, these are for old text
+                    self.set_results(results)
+
+_suggester = None
+_suggester_lock = threading.Lock()
+
+def get_suggester() -> Suggester:
+    global _suggester
+    with _suggester_lock:
+        if _suggester is None:
+            _suggester = Suggester()
+        return _suggester
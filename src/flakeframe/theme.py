@@ -3,7 +3,7 @@ import os
 import sys
 from dataclasses import dataclass
 from typing import List, Optional, Dict
-from flakeframe.input import read_key
+from flakeframe.input import read_key, session
 from flakeframe.ui import display_width, display_center, get_terminal_size, goto, clear
 
 @dataclass
@@ -158,12 +158,14 @@ class ThemeUI:
             sys.stdout.write("│" + "[q]uit".center(box_w) + "│")
                 
             sys.stdout.flush()
-            input()
+            with session.suspended():
+                input()
             
     def run_menu(self):
         clear()
         print("not implemented!")
-        input("[any]")
+        with session.suspended():
+            input("[any]")
         return("quit")
         
         while(True):
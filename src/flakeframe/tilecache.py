@@ -0,0 +1,386 @@
+# Persistent tile store, plugged in below staticmaps' tile fetch
+
+import atexit
+import json
+import os
+import threading
+import time
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+import staticmaps # py-staticmaps
+from flakeframe.cache import cache_dir
+from flakeframe.trace import span
+
+TILE_CACHE_BUDGET = 256 * 1024 * 1024 # bytes on disk
+TILE_TTL = 30 * 24 * 3600             # seconds before a tile gets revalidated
+PACK_SIZE = 32 * 1024 * 1024          # roll over to a new pack file after this
+
+MAX_IN_FLIGHT = 16        # concurrent tile requests, also the keep-alive pool size
+TILE_TIMEOUT = (3.05, 10) # connect, read
+TILE_RETRIES = 3
+RETRY_BACKOFF = 0.25      # seconds, doubles every retry
+OFFLINE_BACKOFF = 10      # after a tile fails on connection errors, don't try the network for this long
+
+INDEX_FILE = "index.json"
+
+class TileStore:
+    # tiles get appended to a few pack files, the index maps provider/z/x/y to where they live
+    # entry: [pack, offset, length, fetched, last_used, etag]
+    def __init__(self, path, budget = TILE_CACHE_BUDGET, ttl = TILE_TTL, pack_size = PACK_SIZE, readonly = False):
+        self.path = path
+        self.readonly = readonly # another process owns the files, downloads are used but not kept
+        self.budget = budget
+        self.ttl = ttl
+        self.pack_size = max(1, min(pack_size, budget // 4))
+        self.lock = threading.RLock()
+        self.index = {}
+        self.packs = {}   # pack id -> bytes written
+        self.handles = {}
+        self.live = 0     # bytes referenced by the index
+        self.dirty = False
+        self.touched = False
+        os.makedirs(path, exist_ok = True)
+        self.load()
+
+    def pack_path(self, pack):
+        return os.path.join(self.path, f"pack-{pack:04d}.bin")
+
+    def load(self):
+        for name in os.listdir(self.path):
+            if name.startswith("pack-") and name.endswith(".bin"):
+                pack = int(name[5:-4])
+                self.packs[pack] = os.path.getsize(os.path.join(self.path, name))
+
+        try:
+            with open(os.path.join(self.path, INDEX_FILE)) as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            index = {}
+
+        for key, entry in index.items():
+            pack, offset, length = entry[0], entry[1], entry[2]
+            if offset + length <= self.packs.get(pack, -1): # drop anything a crash cut short
+                self.index[key] = entry
+                self.live += length
+
+        # packs the index doesn't know about are garbage
+        if self.readonly:
+            return
+        used = {entry[0] for entry in self.index.values()}
+        for pack in list(self.packs):
+            if pack not in used:
+                self.remove_pack(pack)
+
+    def save(self):
+        tmp = os.path.join(self.path, INDEX_FILE + ".tmp")
+        with open(tmp, "w") as f:
+            json.dump(self.index, f, separators = (",", ":"))
+        os.replace(tmp, os.path.join(self.path, INDEX_FILE))
+
+    def flush(self, force = False):
+        # new tiles get saved right away, LRU timestamps only when forced (exit)
+        with self.lock:
+            if self.readonly:
+                return
+            if self.dirty or (force and self.touched):
+                self.save()
+                self.dirty = False
+                self.touched = False
+
+    def close(self):
+        with self.lock:
+            self.flush(force = True)
+            for f in self.handles.values():
+                f.close()
+            self.handles.clear()
+
+    def handle(self, pack):
+        f = self.handles.get(pack)
+        if f is None:
+            f = open(self.pack_path(pack), "rb" if self.readonly else "a+b")
+            self.handles[pack] = f
+        return f
+
+    def remove_pack(self, pack):
+        f = self.handles.pop(pack, None)
+        if f:
+            f.close()
+        try:
+            os.remove(self.pack_path(pack))
+        except OSError:
+            pass
+        self.packs.pop(pack, None)
+
+    def active_pack(self):
+        pack = max(self.packs, default = 0)
+        if self.packs.get(pack, 0) >= self.pack_size:
+            pack += 1
+        self.packs.setdefault(pack, 0)
+        return pack
+
+    def read(self, entry):
+        f = self.handle(entry[0])
+        f.seek(entry[1])
+        return f.read(entry[2])
+
+    def append(self, data):
+        pack = self.active_pack()
+        f = self.handle(pack)
+        f.seek(0, os.SEEK_END)
+        offset = f.tell()
+        f.write(data)
+        f.flush()
+        self.packs[pack] = offset + len(data)
+        return pack, offset
+
+    def get(self, provider, z, x, y):
+        # returns (data, etag, fresh), data is None on a miss
+        key = f"{provider}/{z}/{x}/{y}"
+        with self.lock:
+            entry = self.index.get(key)
+            if entry is None:
+                return None, None, False
+            try:
+                data = self.read(entry)
+            except OSError: # read-only and the owner compacted the pack away
+                return None, None, False
+            entry[4] = time.time()
+            self.touched = True
+            return data, entry[5], time.time() - entry[3] < self.ttl
+
+    def put(self, provider, z, x, y, data, etag = None):
+        key = f"{provider}/{z}/{x}/{y}"
+        if self.readonly:
+            return
+        with self.lock:
+            old = self.index.get(key)
+            if old is not None:
+                self.live -= old[2]
+            pack, offset = self.append(data)
+            now = time.time()
+            self.index[key] = [pack, offset, len(data), now, now, etag]
+            self.live += len(data)
+            self.dirty = True
+            if self.live > self.budget:
+                self.evict(self.budget * 0.8)
+            if sum(self.packs.values()) > self.budget * 1.25: # too much dead weight in the packs
+                self.evict(self.budget * 0.8)
+                self.compact()
+
+    def fresh(self, provider, z, x, y) -> bool:
+        with self.lock:
+            entry = self.index.get(f"{provider}/{z}/{x}/{y}")
+            return entry is not None and time.time() - entry[3] < self.ttl
+
+    def revalidated(self, provider, z, x, y):
+        # server said 304, tile is good for another ttl
+        key = f"{provider}/{z}/{x}/{y}"
+        with self.lock:
+            entry = self.index.get(key)
+            if entry is not None:
+                entry[3] = time.time()
+                self.dirty = True
+
+    def evict(self, target):
+        # drop least recently used tiles until we're under target
+        if self.live <= target:
+            return
+        for key, entry in sorted(self.index.items(), key = lambda item: item[1][4]):
+            if self.live <= target:
+                break
+            del self.index[key]
+            self.live -= entry[2]
+        self.dirty = True
+
+    def compact(self):
+        # closed packs with dead tiles get their survivors moved to the active pack
+        active = self.active_pack()
+        live_per_pack = {}
+        for entry in self.index.values():
+            live_per_pack[entry[0]] = live_per_pack.get(entry[0], 0) + entry[2]
+
+        for pack, size in list(self.packs.items()):
+            if pack == active or live_per_pack.get(pack, 0) >= size:
+                continue
+            for entry in self.index.values():
+                if entry[0] == pack:
+                    data = self.read(entry)
+                    entry[0], entry[1] = self.append(data)
+            self.remove_pack(pack)
+        self.dirty = True
+
+    def stats(self):
+        with self.lock:
+            return {
+                "tiles": len(self.index),
+                "live_bytes": self.live,
+                "disk_bytes": sum(self.packs.values()),
+                "packs": len(self.packs),
+            }
+
+class CachedTileDownloader(staticmaps.TileDownloader):
+    def __init__(self, store: TileStore):
+        super().__init__()
+        self.store = store
+        self.failed = set() # tiles prefetch already gave up on, so staticmaps doesn't retry them one by one
+
+    def get(self, provider, cache_dir, zoom, x, y):
+        # cache_dir is staticmaps' one-file-per-tile cache, we ignore it on purpose
+        if (zoom, x, y) in self.failed:
+            raise RuntimeError(f"tile {zoom}/{x}/{y} unavailable") # staticmaps skips tiles on RuntimeError
+        return self.fetch(provider, zoom, x, y)
+
+    def fetch(self, provider, zoom, x, y):
+        if hasattr(provider, "read"): # an offline pack, only what it doesn't have goes further
+            data = provider.read(zoom, x, y)
+            if data is not None:
+                return data
+            if provider.fallback is None:
+                raise RuntimeError(f"tile {zoom}/{x}/{y} not in {provider.name()}")
+            provider = provider.fallback
+        name = provider.name()
+        data, etag, fresh = self.store.get(name, zoom, x, y)
+        if data is not None and fresh:
+            return data
+
+        try:
+            new_data, new_etag = self.download(provider, zoom, x, y, etag if data is not None else None)
+        except RuntimeError:
+            if data is not None:
+                return data # stale beats nothing
+            raise
+
+        if new_data is None and data is not None: # 304
+            self.store.revalidated(name, zoom, x, y)
+            return data
+        if new_data is not None:
+            self.store.put(name, zoom, x, y, new_data, new_etag)
+        return new_data
+
+    def prefetch(self, provider, zoom, tiles):
+        # grab everything a view needs at once, render_pillow then only reads the store
+        name = provider.name()
+        futures = {}
+        packed = getattr(provider, "has", None)
+        fallback = getattr(provider, "fallback", None)
+        stored = fallback.name() if fallback is not None else name # fetch keeps a pack's misses under the fallback's name
+        for x, y in tiles:
+            if self.store.fresh(stored, zoom, x, y) or (packed and packed(zoom, x, y)):
+                continue
+            key = (name, zoom, x, y)
+            with _inflight_lock:
+                future = _inflight.get(key) # another render already wants this one
+                if future is None:
+                    future = get_fetch_pool().submit(self.fetch, provider, zoom, x, y)
+                    _inflight[key] = future
+                    future.add_done_callback(lambda _, key = key: _forget_inflight(key))
+            futures[(x, y)] = future
+
+        for (x, y), future in futures.items():
+            try:
+                future.result()
+            except RuntimeError:
+                self.failed.add((zoom, x, y))
+
+    def download(self, provider, zoom, x, y, etag = None):
+        with span("tile fetch", "net", tile = f"{zoom}/{x}/{y}", revalidate = etag is not None):
+            return self.request(provider, zoom, x, y, etag)
+
+    def request(self, provider, zoom, x, y, etag = None):
+        url = provider.url(zoom, x, y)
+        if url is None:
+            return None, None
+
+        global _offline_until
+        if time.monotonic() < _offline_until:
+            raise RuntimeError(f"fetch {url} skipped, network looks down")
+
+        headers = {"user-agent": self._user_agent}
+        if etag:
+            headers["if-none-match"] = etag
+
+        for attempt in range(TILE_RETRIES):
+            offline = False
+            try:
+                res = get_session().get(url, headers = headers, timeout = TILE_TIMEOUT)
+            except requests.RequestException as e:
+                error = f"fetch {url} failed: {e}"
+                offline = isinstance(e, (requests.ConnectionError, requests.Timeout))
+            else:
+                if res.status_code == 304:
+                    return None, etag
+                if res.status_code == 200:
+                    return res.content, res.headers.get("etag")
+                error = f"fetch {url} yields {res.status_code}"
+                if res.status_code not in (429, 500, 502, 503, 504):
+                    break # retrying a 404 won't help
+
+            if attempt + 1 < TILE_RETRIES:
+                time.sleep(RETRY_BACKOFF * 2 ** attempt)
+
+        if offline:
+            _offline_until = time.monotonic() + OFFLINE_BACKOFF
+        raise RuntimeError(error)
+
+_session = None
+_fetch_pool = None
+_net_lock = threading.Lock()
+_inflight = {}
+_inflight_lock = threading.RLock()
+_offline_until = 0
+
+def _forget_inflight(key):
+    with _inflight_lock:
+        _inflight.pop(key, None)
+
+def get_session() -> requests.Session:
+    # keep-alive connections to the tile host, shared by every render
+    global _session
+    with _net_lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = HTTPAdapter(pool_connections = 4, pool_maxsize = MAX_IN_FLIGHT)
+            _session.mount("https://", adapter)
+            _session.mount("http://", adapter)
+        return _session
+
+def get_fetch_pool() -> ThreadPoolExecutor:
+    # one pool for all renders so the number of requests in flight stays bounded
+    global _fetch_pool
+    with _net_lock:
+        if _fetch_pool is None:
+            _fetch_pool = ThreadPoolExecutor(max_workers = MAX_IN_FLIGHT, thread_name_prefix = "tile-fetch")
+        return _fetch_pool
+
+_store = None
+_store_lock = threading.Lock()
+_store_settings = {"budget": TILE_CACHE_BUDGET, "ttl": TILE_TTL, "readonly": False}
+
+def configure_tile_cache(budget_mb = None, ttl_days = None, readonly = None):
+    if readonly is not None:
+        _store_settings["readonly"] = readonly # only takes effect before the store is opened
+    if budget_mb is not None:
+        _store_settings["budget"] = int(budget_mb * 1024 * 1024)
+    if ttl_days is not None:
+        _store_settings["ttl"] = ttl_days * 24 * 3600
+
+    if _store is not None:
+        with _store.lock:
+            _store.budget = _store_settings["budget"]
+            _store.ttl = _store_settings["ttl"]
+
+def tile_cache_settings():
+    # to hand to worker processes, in configure_tile_cache's units
+    return {"budget_mb": _store_settings["budget"] / (1024 * 1024), "ttl_days": _store_settings["ttl"] / (24 * 3600)}
+
+def get_tile_store() -> TileStore:
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = TileStore(cache_dir("tiles"), **_store_settings)
+            atexit.register(_store.close)
+        return _store
+
+def get_tile_downloader() -> CachedTileDownloader:
+    return CachedTileDownloader(get_tile_store())
@@ -0,0 +1,148 @@
+# Maps stitched together from per-tile blocks of character cells
+# the view snaps to a grid where every map tile is exactly TILE_COLS x tile_lines(cell) cells, so a tile's glyphs
+# don't depend on where it lands on screen and get converted once, pans, refreshes and resizes only stitch
+
+import time
+from io import BytesIO
+from PIL import Image
+from flakeframe.blocks import GLYPH_W, GLYPH_H
+from flakeframe.cache import LRUCache
+from flakeframe.map import (RenderCancelled, convert_map, get_cell_size, latlon_to_world, optimizer_name, pick_resampler,
+                            row_height, tile_provider)
+from flakeframe.tilecache import get_tile_downloader
+from flakeframe.trace import span
+
+TILE_PX = 256                 # world pixels per tile, same as latlon_to_world
+TILE_COLS = TILE_PX // GLYPH_W
+GLYPH_CACHE_SIZE = 512        # tiles, a full screen at 200x60 is ~40 and the pan canvas four times that
+BLANK_CELL = "\x1b[38;2;40;40;40m\x1b[48;2;40;40;40m " # tiles that couldn't be had, off the top/bottom of the world
+
+# (provider, z, x, y, lines per tile, optimizer) -> rows of cells
+glyph_cache = LRUCache(GLYPH_CACHE_SIZE)
+
+def tile_lines(cell) -> int:
+    # character rows per tile, rounded to whole rows so tiles stack, the vertical scale is off by under half a row a tile
+    return max(1, round(TILE_PX / row_height(cell)))
+
+def tile_key(provider, zoom, x, y, lines, fast, native):
+    return (provider.name(), zoom, x, y, lines, optimizer_name(fast, native))
+
+def grid_window(lat, lon, zoom, cols, lines, per_tile):
+    # -> (left, top) cell of a view on the tile grid, and the (tx0, ty0, tx1, ty1) tiles it touches, x unwrapped
+    wx, wy = latlon_to_world(lat, lon, zoom)
+    left = round(wx / GLYPH_W - cols / 2)
+    top = round(wy / TILE_PX * per_tile - lines / 2)
+    return (left, top), (left // TILE_COLS, top // per_tile, (left + cols - 1) // TILE_COLS, (top + lines - 1) // per_tile)
+
+def grid_tiles(lat, lon, zoom, cols, lines, per_tile):
+    # the (x, y) tiles a view needs
+    n = 1 << zoom
+    _, (tx0, ty0, tx1, ty1) = grid_window(lat, lon, zoom, cols, lines, per_tile)
+    return [(tx % n, ty) for ty in range(max(0, ty0), min(n - 1, ty1) + 1) for tx in range(tx0, tx1 + 1)]
+
+def convert_tile(data, lines, fast, native):
+    image = Image.open(BytesIO(data)).convert("RGB")
+    grid = (TILE_COLS * GLYPH_W, lines * GLYPH_H)
+    resampler = pick_resampler(image.size, grid)
+    if resampler is not None:
+        image = image.resize(grid, resample = resampler)
+    return convert_map(image, TILE_COLS, fast, native)
+
+def stitch(blocks, left, top, tx0, tx1, cols, lines, per_tile):
+    # cols x lines cells cut out of the (tx, ty) -> block tiles, blank where there's no block
+    blank = [BLANK_CELL] * TILE_COLS
+    offset = left - tx0 * TILE_COLS
+    rows = []
+    for gy in range(top, top + lines):
+        ty, oy = divmod(gy, per_tile)
+        row = []
+        for tx in range(tx0, tx1 + 1):
+            block = blocks.get((tx, ty))
+            row.extend(block[oy] if block is not None else blank)
+        rows.append(row[offset:offset + cols])
+    return rows
+
+def tiled_cells(lat, lon, zoom, cols, lines, fast = False, native = False, cancelled = None, timings = None):
+    # cols x lines cells around lat/lon, converting only tiles the cache hasn't seen
+    start = time.perf_counter()
+    per_tile = tile_lines(get_cell_size())
+    provider = tile_provider()
+    n = 1 << zoom
+
+    (left, top), (tx0, ty0, tx1, ty1) = grid_window(lat, lon, zoom, cols, lines, per_tile)
+
+    blocks = {}
+    missing = {}
+    for ty in range(max(0, ty0), min(n - 1, ty1) + 1):
+        for tx in range(tx0, tx1 + 1):
+            key = tile_key(provider, zoom, tx % n, ty, per_tile, fast, native)
+            block = glyph_cache.get(key)
+            if block is None:
+                missing[(tx, ty)] = key
+            else:
+                blocks[(tx, ty)] = block
+
+    cached = len(blocks)
+    downloader = get_tile_downloader()
+    if missing:
+        with span("tiles", "net", zoom = zoom):
+            downloader.prefetch(provider, zoom, sorted({(tx % n, ty) for tx, ty in missing}))
+        downloader.store.flush()
+    fetched = time.perf_counter()
+    if cancelled and cancelled():
+        raise RenderCancelled()
+
+    with span("glyph tiles", "render", new = len(missing), cached = cached, optimizer = optimizer_name(fast, native)):
+        for (tx, ty), key in missing.items():
+            _, _, x, y, _, _ = key
+            try:
+                data = downloader.get(provider, None, zoom, x, y)
+            except RuntimeError:
+                data = None
+            if not data:
+                continue # blank for now, not cached so it gets another go next frame
+            try:
+                block = convert_tile(data, per_tile, fast, native)
+            except OSError: # an error page or a truncated download instead of an image, blank like a missing one
+                continue
+            glyph_cache.put(key, block)
+            blocks[(tx, ty)] = block
+            if cancelled and cancelled():
+                raise RenderCancelled()
+    converted = time.perf_counter()
+
+    with span("stitch", "render"):
+        rows = stitch(blocks, left, top, tx0, tx1, cols, lines, per_tile)
+
+    if timings is not None:
+        timings["map render"] = fetched - start
+        timings["glyphs"] = converted - fetched
+        timings["stitch"] = time.perf_counter() - converted
+        timings["tiles"] = f"{len(blocks) - cached} new, {cached} cached"
+    return rows
+
+def tiled_preview(lat, lon, zoom, cols, lines, fast = False, native = False):
+    # the next zoom out, from the glyph cache with every cell doubled, None when none of it is cached
+    # no composed image on the tiled path to blow up, this is the stand-in while the new tiles convert
+    if zoom < 1:
+        return None
+    per_tile = tile_lines(get_cell_size())
+    provider = tile_provider()
+    n = 1 << (zoom - 1)
+    half_cols, half_lines = (cols + 1) // 2, (lines + 1) // 2
+    (left, top), (tx0, ty0, tx1, ty1) = grid_window(lat, lon, zoom - 1, half_cols, half_lines, per_tile)
+
+    blocks = {}
+    for ty in range(max(0, ty0), min(n - 1, ty1) + 1):
+        for tx in range(tx0, tx1 + 1):
+            block = glyph_cache.peek(tile_key(provider, zoom - 1, tx % n, ty, per_tile, fast, native))
+            if block is not None:
+                blocks[(tx, ty)] = block
+    if not blocks:
+        return None
+
+    rows = []
+    for row in stitch(blocks, left, top, tx0, tx1, half_cols, half_lines, per_tile):
+        wide = [cell for cell in row for _ in (0, 1)][:cols]
+        rows += [wide, wide]
+    return rows[:lines]
@@ -0,0 +1,134 @@
+# Timing spans for finding out where the time goes on someone's machine
+# with tracing off a span is one global check and a shared do-nothing object
+# export is chrome trace-event json, open it in chrome://tracing or ui.perfetto.dev
+
+import atexit
+import json
+import os
+import threading
+import time
+from collections import deque
+
+TRACE_MAX_EVENTS = 200_000 # oldest get dropped past this, a long session shouldn't eat all memory
+TRACE_ROOTS = 16           # finished top level spans kept per name, with their breakdown
+
+enabled = False
+export_path = None # chrome trace written here on exit
+_events = deque(maxlen = TRACE_MAX_EVENTS) # (name, cat, start ns, duration ns, thread id, args)
+_roots = {}                                # name -> deque of (args, duration ns, [(child name, duration ns)])
+_threads = {}                              # thread id -> name
+_local = threading.local()
+_origin = time.perf_counter_ns()
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def set(self, **args):
+        pass
+
+NULL_SPAN = _NullSpan()
+
+class Span:
+    __slots__ = ("name", "cat", "args", "start", "children")
+
+    def __init__(self, name, cat, args):
+        self.name = name
+        self.cat = cat
+        self.args = args
+        self.children = None
+
+    def set(self, **args):
+        # things only known once it's done, e.g. bytes written
+        self.args.update(args)
+
+    def __enter__(self):
+        stack = getattr(_local, "stack", None)
+        if stack is None:
+            stack = _local.stack = []
+            _threads[threading.get_ident()] = threading.current_thread().name
+        if not stack:
+            self.children = [] # top level, collects a breakdown of what happened inside
+        stack.append(self)
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc):
+        duration = time.perf_counter_ns() - self.start
+        stack = _local.stack
+        stack.pop()
+        if exc[0] is not None:
+            self.args["error"] = exc[0].__name__ # e.g. a render that got cancelled halfway
+        _events.append((self.name, self.cat, self.start, duration, threading.get_ident(), self.args))
+        if len(stack) == 1: # direct children only, their own insides are already in their time
+            if stack[0].children is not None:
+                stack[0].children.append((self.name, duration))
+        elif not stack:
+            roots = _roots.get(self.name)
+            if roots is None:
+                roots = _roots.setdefault(self.name, deque(maxlen = TRACE_ROOTS))
+            roots.append((self.args, duration, self.children))
+        return False
+
+def span(name, cat = "app", **args):
+    # with span("resize"): ...
+    if not enabled:
+        return NULL_SPAN
+    return Span(name, cat, args)
+
+def enable():
+    global enabled
+    enabled = True
+
+def disable():
+    global enabled
+    enabled = False
+
+def start(path):
+    # trace the whole run and write it out at exit
+    global export_path
+    if export_path is None:
+        atexit.register(lambda: export_chrome(export_path))
+    export_path = path
+    enable()
+
+def clear():
+    _events.clear()
+    _roots.clear()
+
+def last_root(name, **match):
+    # -> (args, duration ns, [(child, duration ns)]) of the newest finished top level span called name whose
+    # args include match, or None
+    for args, duration, children in reversed(_roots.get(name, ())):
+        if all(args.get(k) == v for k, v in match.items()):
+            return args, duration, children
+    return None
+
+def breakdown(children):
+    # [(name, ns)] -> {name: total ms} in first seen order, repeated stages add up
+    totals = {}
+    for name, duration in children:
+        totals[name] = totals.get(name, 0) + duration / 1e6
+    return totals
+
+def export_chrome(path):
+    # complete ("X") events, times in microseconds since the process started tracing
+    pid = os.getpid()
+    events = [
+        {"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": name}}
+        for tid, name in list(_threads.items())
+    ]
+    for name, cat, start, duration, tid, args in list(_events):
+        event = {"name": name, "cat": cat, "ph": "X", "pid": pid, "tid": tid,
+                 "ts": (start - _origin) / 1000, "dur": duration / 1000}
+        if args:
+            event["args"] = {k: v if isinstance(v, (int, float, str, bool)) or v is None else str(v) for k, v in args.items()}
+        events.append(event)
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+    os.replace(tmp, path)
+    return len(events)
@@ -1,20 +1,21 @@
 import sys
 import shutil
-import json
 import re
-import time
 from flakeframe.input import read_key
-from flakeframe.geocode import validate_input_live, parse_coordinates
+from flakeframe.geocode import validate_input_live, parse_coordinates, needs_network
+from flakeframe.screen import screen
+from flakeframe.suggest import get_suggester
 
 CONFIG_FILE = "flakeframe.json"
 
 BOX_WIDTH = 40
-BOX_HEIGHT = 10
+BOX_HEIGHT = 11
 
 COLOR_RESET = "\x1b[0m"
 COLOR_BORDER = "\x1b[38;2;40;230;180m"
 COLOR_HIGHLIGHT = "\x1b[38;2;180;160;220m----> "
 COLOR_SELECTED = "\x1b[38;2;255;128;120m> "
+COLOR_SUGGESTION = "\x1b[38;2;180;160;220m"
 COLOR_PROMPT = ""
 
 def display_width(s):
@@ -23,8 +24,11 @@ def display_width(s):
     return len(s)
 
 def clear():
+    # for code that draws straight to stdout, the screen buffer has to start over after this
+    screen.wait()
     sys.stdout.write("\x1b[2J\x1b[H")
     sys.stdout.flush()
+    screen.invalidate()
 
 def display_center(text: str, size: int):
     padding = size - display_width(text)
@@ -45,17 +49,20 @@ class SettingsUI:
             {"name": "show_map"    , "label": "\x1b[38;2;255;255;128mShow Map?",          "states": ["Yes", "No", "Only"], "value": config["DEFAULT"]["show_map"]},
             {"name": "themes",       "label": "Themes...",                                "states": None, "value": None},
             {"name": "search", "label": "Search Locations" , "states": None          , "value": None},
+            {"name": "dashboard", "label": "Saved Locations", "states": None         , "value": None},
             {"name": "quit"  , "label": "\x1b[38;2;255;128;120mQuit :("          , "states": None          , "value": None},
         ]
         self.current_option = 0
         self.search_mode = False
         self.search_input = ""
         self.suggestions = []
-        self.selected_sugg = 0
+        self.selected_sugg = -1 # -1 = use what was typed
+        self.suggester = get_suggester()
+        self.status = None # (text, colour), overrides the live search status until the next key
         self.config = config
     
     def draw_ui(self):
-        clear()
+        screen.begin()
         lines = [
             "flakeframe | setup",
             ""
@@ -77,30 +84,47 @@ class SettingsUI:
         box_y = (term_h - BOX_HEIGHT) // 2
         
         prompt_y = box_y + 7
-        status_y = prompt_y + 2
+        status_y = box_y + BOX_HEIGHT - 1 # on the bottom border
         
-        sys.stdout.write(f"\x1b[{box_y + self.current_option + 3};{box_x - 2}H{COLOR_HIGHLIGHT}")
-        sys.stdout.write(f"\x1b[{box_y + self.current_option + 3};{box_x - 3}H")
-        sys.stdout.flush()
+        screen.write(f"\x1b[{box_y + self.current_option + 3};{box_x - 2}H{COLOR_HIGHLIGHT}")
+        screen.write(f"\x1b[{box_y + self.current_option + 3};{box_x - 3}H")
         
         if self.search_mode:
             prompt = f"{COLOR_PROMPT}\x1b[38;2;180;160;220m>... {self.search_input}{COLOR_RESET}"
-            sys.stdout.write(f"\x1b[{prompt_y};{box_x + 1}H                           ")
-            sys.stdout.write(f"\x1b[{prompt_y};{box_x + 1}H{prompt.ljust(BOX_WIDTH - 6)}")
+            screen.write(f"\x1b[{prompt_y};{box_x + 1}H                           ")
+            screen.write(f"\x1b[{prompt_y};{box_x + 1}H{prompt.ljust(BOX_WIDTH - 6)}")
             
-            is_valid, lat, lon, status = validate_input_live(self.search_input)
-            color = "\x1b[32m" if is_valid else "\x1b[31m"
-            sys.stdout.write(f"\x1b[{status_y};{box_x + 3}H{color}{status}{COLOR_RESET}")
+            if self.status:
+                status, color = self.status
+                screen.write(f"\x1b[{status_y};{box_x + 3}H{color}{status}{COLOR_RESET}")
+            else:
+                is_valid, lat, lon, status = validate_input_live(self.search_input)
+                color = "\x1b[32m" if is_valid else "\x1b[31m"
+                screen.write(f"\x1b[{status_y};{box_x + 3}H{color}{status}{COLOR_RESET}")
+            
+            for i, sugg in enumerate(self.suggestions):
+                # same width either way so the selected row doesn't jump sideways
+                marker = COLOR_SELECTED if i == self.selected_sugg else COLOR_SUGGESTION + " " * display_width(COLOR_SELECTED)
+                screen.write(f"\x1b[{status_y + 1 + i};{box_x + 3}H{marker}{sugg.label[:BOX_WIDTH - 4]}{COLOR_RESET}")
                 
             cursor_x = box_x + 1 + display_width(">... ") + len(self.search_input)
-            sys.stdout.write(f"\x1b[{prompt_y};{cursor_x}H")
-            sys.stdout.flush()
+            screen.write(f"\x1b[{prompt_y};{cursor_x}H")
+        screen.present()
                 
     def run(self):
         self.draw_ui()
         
         while True:
-            key = read_key()
+            key = read_key(timeout = 0.05 if self.search_mode else None)
+            if key is None:
+                # suggestions come in between keys
+                if self.suggester.changed.is_set():
+                    self.suggester.changed.clear()
+                    self.suggestions = self.suggester.results if self.search_mode else []
+                    self.selected_sugg = min(self.selected_sugg, len(self.suggestions) - 1)
+                    self.draw_ui()
+                continue
+            self.status = None
             
             if not self.search_mode:
                 # nav mode
@@ -119,32 +143,48 @@ class SettingsUI:
                         return "quit"
                     elif self.options[self.current_option]["name"] == "themes":
                         return "themes"
+                    elif self.options[self.current_option]["name"] == "dashboard":
+                        return "dashboard"
                 
             else:
                 # search mode
+                typed = self.search_input
                 if key == "esc":
                     self.search_mode  = False
                     self.search_input = ""
                 elif key == "backspace":
                     self.search_input = self.search_input[:-1]
+                elif key == "up":
+                    self.selected_sugg = max(-1, self.selected_sugg - 1)
+                elif key == "down":
+                    self.selected_sugg = min(len(self.suggestions) - 1, self.selected_sugg + 1)
                 elif len(key) == 1 and key.isprintable():
                     if len(self.search_input) <= 32:
                         self.search_input += key
+                elif key == "enter" and self.selected_sugg >= 0:
+                    sugg = self.suggestions[self.selected_sugg]
+                    self.search_mode = False
+                    self.search_input = ""
+                    self.suggester.update("")
+                    return (sugg.lat, sugg.lon)
                 elif key == "enter":
+                    if needs_network(self.search_input):
+                        self.status = ("Searching...", "\x1b[33m") # can take a moment, nominatim is rate limited
+                        self.draw_ui()
                     lat, lon, invalid = parse_coordinates(self.search_input, final = True)
                     if invalid:
-                        term_w, term_h = get_terminal_size()
-                        status_y = ((term_h - BOX_HEIGHT) // 2) + 9
-                        box_x = (term_w - BOX_WIDTH) // 2
-                        
-                        sys.stdout.write(f"\x1b[{status_y};{box_x + 3}H\x1b[31mLocation not found!{COLOR_RESET}")
-                        sys.stdout.flush()
-                        time.sleep(1.2) # avoid rate limit
+                        self.status = ("Location not found!", "\x1b[31m")
                         
                     if lat and lon:
                         self.search_mode = False
                         self.search_input = ""
+                        self.suggester.update("")
                         return (lat, lon)
+                        
+                if self.search_input != typed:
+                    self.selected_sugg = -1
+                    self.suggester.update(self.search_input)
+                    self.suggestions = self.suggester.results # cached ones are there straight away
                     
             self.draw_ui()
     
@@ -158,29 +198,60 @@ class SettingsUI:
             save_config(self.config) # noqa - from MAIN.PY
         
 def draw_box(lines):
-    clear()
     term_width, term_height = get_terminal_size()
     start_x = (term_width - BOX_WIDTH) // 2
     start_y = (term_height - BOX_HEIGHT) // 2
     
-    sys.stdout.write(f"\x1b[{start_y};{start_x}H")
-    sys.stdout.write("\x1b[38;2;40;230;180m╭" + "─" * (BOX_WIDTH - 2) + "╮\n")
+    screen.write(f"\x1b[{start_y};{start_x}H")
+    screen.write("\x1b[38;2;40;230;180m╭" + "─" * (BOX_WIDTH - 2) + "╮\n")
     
     content_height = BOX_HEIGHT - 2
     for i in range(content_height):
         y = start_y + 1 + i
         if i < len(lines):
             padded = display_center(lines[i], BOX_WIDTH - 2)
-            sys.stdout.write(f"\x1b[{y};{start_x}H\x1b[38;2;40;230;180m│{padded}│")
+            screen.write(f"\x1b[{y};{start_x}H\x1b[38;2;40;230;180m│{padded}│")
         else:
-            sys.stdout.write(f"\x1b[{y};{start_x}\x1b[38;2;40;230;180mH│{" " * (BOX_WIDTH - 2)}│")
+            screen.write(f"\x1b[{y};{start_x}H\x1b[38;2;40;230;180m│{" " * (BOX_WIDTH - 2)}│")
             
     bottom_y = start_y + BOX_HEIGHT - 1
-    sys.stdout.write(f"\x1b[{bottom_y};{start_x}H\x1b[38;2;40;230;180m╰" + "─" * (BOX_WIDTH - 2) + "╯")
-    sys.stdout.flush()
+    screen.write(f"\x1b[{bottom_y};{start_x}H\x1b[38;2;40;230;180m╰" + "─" * (BOX_WIDTH - 2) + "╯")
     
 def save_config(config):
     with open(CONFIG_FILE, "w") as f:
         config.write(f)
+
+def saved_locations(config):
+    # [locations] section, name = lat, lon -> [(name, lat, lon)] in the order they were saved
+    if not config.has_section("locations"):
+        return []
+    found = []
+    for name, value in config.items("locations"):
+        if name in config.defaults():
+            continue # DEFAULT keys show up in every section
+        try:
+            lat, lon = (float(v) for v in value.split(","))
+        except ValueError:
+            continue
+        found.append((name, lat, lon))
+    return found
+
+def location_name(lat, lon) -> str:
+    return f"{lat:.4f}, {lon:.4f}"
+
+def is_saved(config, lat, lon) -> bool:
+    return any(location_name(lat, lon) == location_name(la, lo) for _, la, lo in saved_locations(config))
+
+def save_location(config, lat, lon, name = None):
+    if not config.has_section("locations"):
+        config.add_section("locations")
+    config["locations"][name or location_name(lat, lon)] = f"{lat:.4f}, {lon:.4f}"
+    save_config(config)
+
+def remove_location(config, lat, lon):
+    for name, la, lo in saved_locations(config):
+        if location_name(lat, lon) == location_name(la, lo):
+            config.remove_option("locations", name)
+    save_config(config)
         
 # \x1b[38;2;r;g;bm
\ No newline at end of file
@@ -1,7 +1,21 @@
+import json
+import math
+import os
 import requests
-from datetime import datetime, date
+import threading
+import time
+from array import array
+from bisect import bisect_right
+from datetime import datetime, date, timezone
 from dataclasses import dataclass
 from typing import List, Optional
+from flakeframe.cache import cache_dir
+from flakeframe.trace import span
+
+WEATHER_TTL = 15 * 60   # seconds, can be overridden with weather_ttl_minutes
+WEATHER_PRECISION = 2   # decimals of lat/lon that share a cache entry, ~1km
+WEATHER_KEEP = 24 * 3600 # entries older than this get dropped from disk
+WEATHER_BATCH = 100     # locations per request, keeps the url a sane length
 
 @dataclass
 class CurrentWeather:
@@ -28,13 +42,48 @@ class DailyForecast:
     condition:            str
     precipitation_sum: float
 
+def local_time(epoch, utc_offset) -> datetime:
+    # wall clock at the forecast location, naive like the iso strings open-meteo used to send
+    return datetime.fromtimestamp(epoch + utc_offset, timezone.utc).replace(tzinfo = None)
+
+def float_column(values):
+    try:
+        return array("d", values)
+    except TypeError: # open-meteo sends null for gaps
+        return array("d", (math.nan if v is None else v for v in values))
+
+class HourlySeries:
+    # one array per variable instead of an object per hour, rows get built for the few hours that are shown
+    def __init__(self, times, temperature, codes, precipitation, utc_offset = 0):
+        self.times = array("q", times) # unix seconds
+        self.temperature = float_column(temperature)
+        self.codes = array("h", (-1 if c is None else c for c in codes))
+        self.precipitation = float_column(precipitation)
+        self.utc_offset = utc_offset
+
+    def __len__(self):
+        return len(self.times)
+
+    def __getitem__(self, i) -> HourlyForecast:
+        return HourlyForecast(
+            time =          local_time(self.times[i], self.utc_offset),
+            temperature =   self.temperature[i],
+            condition =     condition(self.codes[i]),
+            precipitation = self.precipitation[i]
+        )
+
+    def next_hours(self, count, now = None) -> List[HourlyForecast]:
+        # the hours starting after now, whatever day they fall on
+        start = bisect_right(self.times, time.time() if now is None else now)
+        return [self[i] for i in range(start, min(start + count, len(self)))]
+
 @dataclass
 class WeatherData:
     latitude:     float
     longitude:    float
     current:      CurrentWeather
-    hourly:       List[HourlyForecast] # count: 5
-    daily:        List[DailyForecast]  # count: 5
+    hourly:       HourlySeries
+    daily:        List[DailyForecast]  # today first
     units_temp:   str
     units_precip: str
 
@@ -80,64 +129,116 @@ def condition(code):
     return WEATHER_CODES.get(code, f"No name for code {code}")
 
 def parse_weather(data, config) -> Optional[WeatherData]:
-    try:
-        current = data["current"]
-        hourly  = data["hourly"]
-        daily   = data["daily"]
-
-        curr_time = datetime.fromisoformat(current["time"].replace("Z", "+00:00"))
-        current_weather = CurrentWeather(
-            time               = curr_time,
-            temperature        = current["temperature_2m"],
-            condition          = condition(current["weather_code"]),
-            wind_speed_kmh     = current["wind_speed_10m"],
-            wind_direction_deg = current["wind_direction_10m"],
-            wind_direction_str = wind_arrow(current["wind_direction_10m"]),
-            precipitation   = current["precipitation"]
-        )
+    with span("weather parse", "weather"):
+        try:
+            current = data["current"]
+            hourly  = data["hourly"]
+            daily   = data["daily"]
+
+            utc_offset = data.get("utc_offset_seconds", 0)
+            curr_time = local_time(current["time"], utc_offset)
+            current_weather = CurrentWeather(
+                time               = curr_time,
+                temperature        = current["temperature_2m"],
+                condition          = condition(current["weather_code"]),
+                wind_speed_kmh     = current["wind_speed_10m"],
+                wind_direction_deg = current["wind_direction_10m"],
+                wind_direction_str = wind_arrow(current["wind_direction_10m"]),
+                precipitation   = current["precipitation"]
+            )
         
-        hourly_list = []
-        for i in range(len(hourly["time"])):
-            h_time = datetime.fromisoformat(hourly["time"][i].replace("Z", "+00:00"))
-            hourly_list.append(HourlyForecast(
-                time =             h_time,
-                temperature =      hourly["temperature_2m"][i],
-                condition =        condition(hourly["weather_code"][i]),
-                precipitation = hourly["precipitation"][i]
-            ))
+            hourly_series = HourlySeries(
+                times =         hourly["time"],
+                temperature =   hourly["temperature_2m"],
+                codes =         hourly["weather_code"],
+                precipitation = hourly["precipitation"],
+                utc_offset =    utc_offset
+            )
             
-        daily_list = []
-        for i in range(len(daily["time"])):
-            d_date = date.fromisoformat(daily["time"][i])
-            daily_list.append(DailyForecast(
-                date =                 d_date,
-                temp_min =             daily["temperature_2m_min"][i],
-                temp_max =             daily["temperature_2m_max"][i],
-                condition =            condition(daily["weather_code"][i]),
-                precipitation_sum = daily["precipitation_sum"][i]
-            ))
+            daily_list = []
+            for i in range(len(daily["time"])):
+                d_date = local_time(daily["time"][i], utc_offset).date()
+                daily_list.append(DailyForecast(
+                    date =                 d_date,
+                    temp_min =             daily["temperature_2m_min"][i],
+                    temp_max =             daily["temperature_2m_max"][i],
+                    condition =            condition(daily["weather_code"][i]),
+                    precipitation_sum = daily["precipitation_sum"][i]
+                ))
         
-        return WeatherData(
-            latitude =     round(data.get("latitude", 0), 2),
-            longitude =    round(data.get("longitude", 0), 2),
-            current =      current_weather,
-            hourly =       hourly_list,
-            daily =        daily_list,
-            units_temp =   config["DEFAULT"]["units_temp"],
-            units_precip = config["DEFAULT"]["units_precip"]
-        )
+            return WeatherData(
+                latitude =     round(data.get("latitude", 0), 2),
+                longitude =    round(data.get("longitude", 0), 2),
+                current =      current_weather,
+                hourly =       hourly_series,
+                daily =        daily_list,
+                units_temp =   config["DEFAULT"]["units_temp"],
+                units_precip = config["DEFAULT"]["units_precip"]
+            )
     
-    except (KeyError, IndexError, ValueError) as e:
-        print(f"WARNING: Failed to parse weather data: {e}")
-        return None
+        except (KeyError, IndexError, ValueError, TypeError, OverflowError) as e:
+            print(f"WARNING: Failed to parse weather data: {e}")
+            return None
         
 
-def fetch_weather(lat, lon, config):
+class WeatherCache:
+    # raw open-meteo responses by rounded location + units, kept on disk between runs
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = {} # key -> {"fetched": epoch, "data": raw json}
+        self.refreshing = set()
+        try:
+            with open(path) as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            pass
+
+    @staticmethod
+    def key(lat, lon, temp_unit, precip_unit, timeformat) -> str:
+        return f"{lat:.{WEATHER_PRECISION}f},{lon:.{WEATHER_PRECISION}f},{temp_unit},{precip_unit},{timeformat}"
+
+    def get(self, key):
+        # -> (raw data, age in seconds), (None, None) on a miss
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None, None
+            return entry["data"], time.time() - entry["fetched"]
+
+    def put(self, key, data):
+        self.put_many({key: data})
+
+    def put_many(self, items):
+        # one file write for a whole batch of locations
+        with self.lock:
+            now = time.time()
+            for key, data in items.items():
+                self.entries[key] = {"fetched": now, "data": data}
+            self.entries = {k: e for k, e in self.entries.items() if now - e["fetched"] < WEATHER_KEEP}
+            tmp = self.path + ".tmp"
+            try:
+                with open(tmp, "w") as f:
+                    json.dump(self.entries, f)
+                os.replace(tmp, self.path)
+            except OSError:
+                pass # cache is a nice to have
+
+_weather_cache = None
+_weather_cache_lock = threading.Lock()
+
+def get_weather_cache() -> WeatherCache:
+    global _weather_cache
+    with _weather_cache_lock:
+        if _weather_cache is None:
+            _weather_cache = WeatherCache(os.path.join(cache_dir(), "weather.json"))
+        return _weather_cache
+
+def weather_params(lat, lon, config):
     temp_unit   = "celsius" if config["DEFAULT"]["units_temp"]   == "°C" else "fahrenheit"
     precip_unit = "mm"      if config["DEFAULT"]["units_precip"] == "mm" else "inch"
     
-    url = "https://api.open-meteo.com/v1/forecast"
-    params = {
+    return {
         "latitude": lat,
         "longitude": lon,
         "current": "temperature_2m,precipitation,wind_speed_10m,wind_direction_10m,weather_code",
@@ -146,9 +247,99 @@ def fetch_weather(lat, lon, config):
         "temperature_unit": temp_unit,
         "precipitation_unit": precip_unit,
         "timezone": "auto",
+        "timeformat": "unixtime", # ints are a lot cheaper to parse than iso strings
     }
-    response = requests.get(url, params = params)
+
+def request_weather(params):
+    url = "https://api.open-meteo.com/v1/forecast"
+    with span("weather fetch", "net", locations = str(params["latitude"]).count(",") + 1) as s:
+        try:
+            response = requests.get(url, params = params, timeout = 10)
+        except requests.RequestException:
+            s.set(error = "network")
+            return None
+        s.set(status = response.status_code)
+        if response.status_code == 200:
+            return response.json()
+        return None
+
+def refresh_weather(key, params, on_update = None, config = None):
+    # background refresh for stale entries, only one per key at a time
+    cache = get_weather_cache()
+    with cache.lock:
+        if key in cache.refreshing:
+            return
+        cache.refreshing.add(key)
+        
+    def worker():
+        try:
+            data = request_weather(params)
+            if data is not None:
+                cache.put(key, data)
+                if on_update:
+                    on_update(parse_weather(data, config))
+        finally:
+            with cache.lock:
+                cache.refreshing.discard(key)
+    threading.Thread(target = worker, daemon = True).start()
+
+def fetch_weather(lat, lon, config, force = False, on_update = None):
+    # fresh cache -> instant, stale cache -> instant + refresh in the background (on_update gets the result)
+    params = weather_params(lat, lon, config)
+    cache = get_weather_cache()
+    key = cache.key(lat, lon, params["temperature_unit"], params["precipitation_unit"], params["timeformat"])
+    ttl = config["DEFAULT"].getfloat("weather_ttl_minutes", WEATHER_TTL / 60) * 60
     
-    if response.status_code == 200:
-        return parse_weather(response.json(), config)
-    return None
\ No newline at end of file
+    cached, age = cache.get(key)
+    if cached is not None and not force:
+        if age >= ttl:
+            refresh_weather(key, params, on_update, config)
+        return parse_weather(cached, config)
+    
+    data = request_weather(params)
+    if data is None:
+        return parse_weather(cached, config) if cached is not None else None # old data beats no data
+    cache.put(key, data)
+    return parse_weather(data, config)
+
+def fetch_weather_batch(locations, config, force = False, cached_only = False, keep = True):
+    # [(lat, lon), ...] -> [WeatherData or None, ...] in the same order, everything the cache can't answer goes
+    # out in one request (open-meteo takes comma separated coordinates and answers with a list)
+    # keep = False doesn't save what comes back, weather.json is for places people look at, not sample points
+    cache = get_weather_cache()
+    ttl = config["DEFAULT"].getfloat("weather_ttl_minutes", WEATHER_TTL / 60) * 60
+    results = [None] * len(locations)
+    keys = []
+    missing = []
+    for i, (lat, lon) in enumerate(locations):
+        params = weather_params(lat, lon, config)
+        key = cache.key(lat, lon, params["temperature_unit"], params["precipitation_unit"], params["timeformat"])
+        keys.append(key)
+        cached, age = cache.get(key)
+        if cached is not None and (cached_only or (not force and age < ttl)):
+            results[i] = parse_weather(cached, config)
+        else:
+            missing.append(i)
+    if cached_only:
+        return results
+
+    for start in range(0, len(missing), WEATHER_BATCH):
+        chunk = missing[start:start + WEATHER_BATCH]
+        params = weather_params(",".join(f"{locations[i][0]:.4f}" for i in chunk),
+                                ",".join(f"{locations[i][1]:.4f}" for i in chunk), config)
+        data = request_weather(params)
+        if isinstance(data, dict):
+            data = [data] # a single location comes back bare
+        if not isinstance(data, list) or len(data) != len(chunk):
+            data = [None] * len(chunk)
+        fresh = {}
+        for i, item in zip(chunk, data):
+            if isinstance(item, dict):
+                fresh[keys[i]] = item
+                results[i] = parse_weather(item, config)
+            else:
+                cached, _ = cache.get(keys[i])
+                results[i] = parse_weather(cached, config) if cached is not None else None # old data beats no data
+        if fresh and keep:
+            cache.put_many(fresh)
+    return results